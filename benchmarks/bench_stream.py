@@ -0,0 +1,306 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Offline benchmark for the HTTP streaming path.
+
+The real aiohttp app is run in a child process, with the Telegram client and the MTProto
+senders replaced by local stand-ins that simulate latency, bandwidth and errors. The parent
+process sends concurrent full and range downloads to it and reports throughput, time to first
+byte and the server's CPU time and peak memory usage.
+
+Run from the repository root, e.g. ``python3 benchmarks/bench_stream.py --latency 0.05``.
+Environment variables are passed on to tgfilestream, so the cache and pool settings described
+in the README can be benchmarked too.
+"""
+from typing import List, Optional, Tuple
+from multiprocessing.connection import Connection as Pipe
+from types import SimpleNamespace
+import multiprocessing
+import argparse
+import datetime
+import tempfile
+import resource
+import asyncio
+import random
+import json
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+home_dc = 2
+chat_id = 1234
+msg_id = 1
+file_name = "bench.bin"
+file_id = (chat_id << 2) | (msg_id << 34)
+
+
+# The simulated file repeats this pattern, so any part of it can be cut out of a copy of the
+# pattern instead of being generated byte by byte.
+pattern = bytes((i * 7 + i // 251) % 256 for i in range(251 * 256))
+double_pattern = pattern * 2
+
+
+def file_bytes(offset: int, length: int) -> bytes:
+    start = offset % len(pattern)
+    if length <= len(pattern):
+        return double_pattern[start:start + length]
+    reps = (start + length) // len(pattern) + 1
+    return (pattern * reps)[start:start + length]
+
+
+class FakeSender:
+    """A stand-in for MTProtoSender that generates file contents locally."""
+    args: argparse.Namespace
+    connected: bool
+
+    def __init__(self, auth_key: object, loop: asyncio.AbstractEventLoop, *, loggers: object,
+                 args: argparse.Namespace) -> None:
+        self.auth_key = auth_key
+        self.args = args
+        self.connected = False
+
+    async def connect(self, connection: object) -> None:
+        await asyncio.sleep(self.args.connect_latency)
+        self.connected = True
+
+    def is_connected(self) -> bool:
+        return self.connected
+
+    async def disconnect(self) -> None:
+        self.connected = False
+
+    async def send(self, request: object) -> object:
+        if not hasattr(request, "offset"):
+            return None
+        if random.random() < self.args.error_rate:
+            await asyncio.sleep(self.args.latency)
+            raise ConnectionError("injected error")
+        data = file_bytes(request.offset,
+                          max(0, min(request.limit, self.args.file_size - request.offset)))
+        await asyncio.sleep(self.args.latency + len(data) / self.args.bandwidth)
+        return SimpleNamespace(bytes=data)
+
+
+class FakeClient:
+    """A stand-in for TelegramClient with the parts used by the web routes and transferrer."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, args: argparse.Namespace) -> None:
+        from telethon.crypto import AuthKey
+        from telethon.tl.types import Document, DcOption
+
+        self.loop = loop
+        self.args = args
+        self.session = SimpleNamespace(dc_id=home_dc, auth_key=AuthKey(bytes(256)))
+        self._log = None
+        self._proxy = None
+        self._dc = DcOption(id=home_dc, ip_address="127.0.0.1", port=443)
+        date = datetime.datetime(2019, 1, 1, tzinfo=datetime.timezone.utc)
+        self.document = Document(id=1, access_hash=2, file_reference=b"", date=date,
+                                 mime_type="application/octet-stream", size=args.file_size,
+                                 dc_id=home_dc, attributes=[])
+        self.message = SimpleNamespace(
+            id=msg_id, chat_id=chat_id, date=date, edit_date=None, media=self.document,
+            file=SimpleNamespace(size=args.file_size, mime_type="application/octet-stream",
+                                 name=file_name, ext=".bin"))
+
+    async def _get_dc(self, dc_id: int) -> object:
+        return self._dc
+
+    def _connection(self, *args: object, **kwargs: object) -> object:
+        return None
+
+    async def get_messages(self, entity: object, ids: int) -> object:
+        await asyncio.sleep(self.args.latency)
+        return self.message
+
+
+def serve(args: argparse.Namespace, pipe: Pipe) -> None:
+    from functools import partial
+
+    from aiohttp import web
+
+    from tgfilestream import paralleltransfer, telegram
+    from tgfilestream.web_routes import routes
+
+    loop = telegram.transfer.loop
+    asyncio.set_event_loop(loop)
+    fake_client = FakeClient(loop, args)
+    paralleltransfer.MTProtoSender = partial(FakeSender, args=args)
+    telegram.transfer.client = fake_client
+    telegram.file_cache.client = fake_client
+    telegram.transfer.post_init()
+
+    app = web.Application()
+    app.add_routes(routes)
+    runner = web.AppRunner(app, access_log=None)
+
+    async def start() -> int:
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        return site._server.sockets[0].getsockname()[1]
+
+    pipe.send(loop.run_until_complete(start()))
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+
+    async def wait_stop() -> None:
+        await loop.run_in_executor(None, pipe.recv)
+
+    loop.run_until_complete(wait_stop())
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    loop.run_until_complete(runner.cleanup())
+    pipe.send({
+        "cpu_seconds": (usage.ru_utime - usage_start.ru_utime)
+                       + (usage.ru_stime - usage_start.ru_stime),
+        # ru_maxrss is in kibibytes on Linux
+        "peak_rss_bytes": usage.ru_maxrss * 1024,
+    })
+
+
+class Result:
+    ttfb: Optional[float] = None
+    bytes: int = 0
+    ok: bool = False
+
+
+async def fetch(session: object, url: str, byte_range: Optional[Tuple[int, int]],
+                verify: bool) -> Result:
+    result = Result()
+    headers = {"Range": f"bytes={byte_range[0]}-{byte_range[1] - 1}"} if byte_range else {}
+    start = time.monotonic()
+    try:
+        async with session.get(url, headers=headers) as resp:
+            if resp.status not in (200, 206):
+                return result
+            expected = int(resp.headers["Content-Length"])
+            offset = byte_range[0] if byte_range else 0
+            async for chunk in resp.content.iter_any():
+                if result.ttfb is None:
+                    result.ttfb = time.monotonic() - start
+                if verify and chunk != file_bytes(offset + result.bytes, len(chunk)):
+                    return result
+                result.bytes += len(chunk)
+            result.ok = result.bytes == expected
+    except Exception:
+        pass
+    return result
+
+
+async def run_clients(args: argparse.Namespace, port: int) -> Tuple[List[Result], float]:
+    import aiohttp
+
+    url = f"http://127.0.0.1:{port}/{file_id}/{file_name}"
+    rand = random.Random(args.seed)
+    ranges: List[Optional[Tuple[int, int]]] = []
+    for _ in range(args.requests):
+        if rand.random() < args.range_fraction:
+            start = rand.randrange(args.file_size)
+            length = min(rand.randint(1, args.max_range), args.file_size - start)
+            ranges.append((start, start + length))
+        else:
+            ranges.append(None)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(session: aiohttp.ClientSession, byte_range: Optional[Tuple[int, int]]
+                      ) -> Result:
+        async with semaphore:
+            return await fetch(session, url, byte_range, args.verify)
+
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=args.timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        start = time.monotonic()
+        results = await asyncio.gather(*[limited(session, byte_range) for byte_range in ranges])
+        return results, time.monotonic() - start
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline tgfilestream streaming benchmark")
+    parser.add_argument("--file-size", type=int, default=64 * 1024 * 1024,
+                        help="size of the simulated file in bytes")
+    parser.add_argument("--requests", type=int, default=200, help="total number of requests")
+    parser.add_argument("--concurrency", type=int, default=20,
+                        help="number of requests in flight at once")
+    parser.add_argument("--range-fraction", type=float, default=0.8,
+                        help="fraction of requests that are range requests")
+    parser.add_argument("--max-range", type=int, default=4 * 1024 * 1024,
+                        help="maximum length of a range request in bytes")
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="simulated round-trip time to Telegram in seconds")
+    parser.add_argument("--connect-latency", type=float, default=0.1,
+                        help="simulated MTProto connection setup time in seconds")
+    parser.add_argument("--bandwidth", type=float, default=100 * 1024 * 1024,
+                        help="simulated bandwidth of a single connection in bytes per second")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="probability of a part request failing")
+    parser.add_argument("--timeout", type=float, default=10,
+                        help="seconds to wait for data before counting a request as failed")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the request mix")
+    parser.add_argument("--verify", action="store_true", help="verify the received bytes")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    os.environ.setdefault("TG_API_ID", "1")
+    os.environ.setdefault("TG_API_HASH", "benchmark")
+    os.environ.setdefault("TG_SESSION_NAME", os.path.join(tempfile.mkdtemp(), "bench"))
+    # All benchmark clients share one IP
+    os.environ.setdefault("REQUEST_LIMIT", str(args.concurrency))
+
+    ctx = multiprocessing.get_context("fork")
+    parent_pipe, child_pipe = ctx.Pipe()
+    server = ctx.Process(target=serve, args=(args, child_pipe), daemon=True)
+    server.start()
+    # Close the child's end here so that recv fails instead of hanging if the server dies
+    child_pipe.close()
+    port = parent_pipe.recv()
+    results, duration = asyncio.run(run_clients(args, port))
+    parent_pipe.send("stop")
+    usage = parent_pipe.recv()
+    server.join()
+
+    total_bytes = sum(result.bytes for result in results)
+    ttfbs = [result.ttfb for result in results if result.ttfb is not None]
+    report = {
+        "requests": len(results),
+        "failed": sum(1 for result in results if not result.ok),
+        "duration_seconds": round(duration, 3),
+        "bytes": total_bytes,
+        "throughput_mib_per_second": round(total_bytes / duration / 1024 / 1024, 2),
+        "ttfb_p50_ms": round(percentile(ttfbs, 0.5) * 1000, 2),
+        "ttfb_p99_ms": round(percentile(ttfbs, 0.99) * 1000, 2),
+        "server_cpu_seconds": round(usage["cpu_seconds"], 3),
+        "server_cpu_seconds_per_gib": (round(usage["cpu_seconds"] / (total_bytes / 1024 ** 3), 3)
+                                       if total_bytes else None),
+        "server_peak_rss_mib": round(usage["peak_rss_bytes"] / 1024 / 1024, 1),
+    }
+    if args.json:
+        print(json.dumps(report))
+    else:
+        for key, value in report.items():
+            print(f"{key:>28}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -23,7 +23,7 @@ setuptools.setup(
 
     install_requires=[
         "aiohttp>=3",
-        "telethon>=1.10",
+        "telethon>=1.24",
         "yarl>=1",
     ],
     extras_require={
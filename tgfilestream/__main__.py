@@ -13,25 +13,47 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import List, Optional
+import subprocess
 import asyncio
+import signal
+import socket
+import time
 import sys
+import os
 
 from aiohttp import web
 from telethon import functions
 
-from .telegram import client, transfer
-from .web_routes import routes
-from .config import host, port, public_url, tg_bot_token
+from . import metrics
+from .telegram import client, transfer, handle_message
+from .web_routes import routes, metrics_middleware, handle_metrics, cluster
+from .config import (host, port, public_url, tg_bot_token, enable_metrics, workers,
+                     worker_index, prewarm_connections, metrics_port)
 from .log import log
 
-server = web.Application()
+server = web.Application(middlewares=[metrics_middleware] if enable_metrics else [])
 server.add_routes(routes)
+if enable_metrics:
+    server.router.add_get("/metrics", handle_metrics)
 runner = web.AppRunner(server)
 
+metrics_runner: Optional[web.AppRunner] = None
+if enable_metrics and metrics_port:
+    # Workers share the main port, so each one serves its own metrics on a separate port
+    metrics_server = web.Application()
+    metrics_server.router.add_get("/metrics", handle_metrics)
+    metrics_runner = web.AppRunner(metrics_server)
+    if worker_index is not None:
+        metrics.common_labels["worker"] = str(worker_index)
+
 loop = asyncio.get_event_loop()
 
 
 async def start() -> None:
+    if worker_index:
+        # Only the first worker handles bot messages
+        client.remove_event_handler(handle_message)
     await client.start(bot_token=tg_bot_token)
 
     config = await client(functions.help.GetConfigRequest())
@@ -43,30 +65,103 @@ async def start() -> None:
             client.session.save()
             break
     transfer.post_init()
+    if prewarm_connections or worker_index == 0:
+        # In multi-worker mode, the first worker makes sure the auth keys of all DCs are in the
+        # auth key file before the other workers are started, so they don't export their own.
+        await transfer.prewarm({option.id for option in config.dc_options
+                                if not option.cdn and not option.media_only})
 
     await runner.setup()
-    await web.TCPSite(runner, host, port).start()
+    await web.TCPSite(runner, host, port, reuse_port=worker_index is not None).start()
+    if metrics_runner:
+        await metrics_runner.setup()
+        await web.TCPSite(metrics_runner, host, metrics_port + (worker_index or 0)).start()
 
 
 async def stop() -> None:
     await runner.cleanup()
+    if metrics_runner:
+        await metrics_runner.cleanup()
+    if cluster:
+        await cluster.close()
+    await transfer.stop()
     await client.disconnect()
 
 
-try:
-    loop.run_until_complete(start())
-except Exception:
-    log.fatal("Failed to initialize", exc_info=True)
-    sys.exit(2)
+def run() -> None:
+    try:
+        loop.run_until_complete(start())
+    except Exception:
+        log.fatal("Failed to initialize", exc_info=True)
+        sys.exit(2)
+
+    log.info("Initialization complete")
+    log.debug(f"Listening at http://{host}:{port}")
+    log.debug(f"Public URL prefix is {public_url}")
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        loop.run_until_complete(stop())
+    except Exception:
+        log.fatal("Fatal error in event loop", exc_info=True)
+        sys.exit(3)
+
+
+def _is_listening() -> bool:
+    try:
+        socket.create_connection(("127.0.0.1" if host in ("0.0.0.0", "::") else host, port),
+                                 timeout=1).close()
+        return True
+    except OSError:
+        return False
+
+
+def supervise() -> int:
+    procs: List[subprocess.Popen] = []
+
+    def spawn(index: int) -> None:
+        env = {**os.environ, "TGFS_WORKER_INDEX": str(index)}
+        procs.append(subprocess.Popen([sys.executable, "-m", "tgfilestream"], env=env))
+
+    def forward_signal(signum: int, _: object) -> None:
+        for proc in procs:
+            proc.send_signal(signum)
+
+    signal.signal(signal.SIGTERM, forward_signal)
+    # Ctrl+C is delivered to the whole process group, so the workers get it by themselves
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    exit_code: Optional[int] = None
+    try:
+        log.info(f"Starting {workers} workers")
+        spawn(0)
+        while not _is_listening():
+            if procs[0].poll() is not None:
+                return procs[0].returncode
+            time.sleep(0.5)
+        for index in range(1, workers):
+            spawn(index)
+        while exit_code is None:
+            time.sleep(1)
+            for index, proc in enumerate(procs):
+                if proc.poll() is not None:
+                    log.warning(f"Worker {index} exited with code {proc.returncode}")
+                    exit_code = proc.returncode
+                    break
+        return exit_code
+    finally:
+        for proc in procs:
+            if proc.poll() is None:
+                proc.terminate()
+        for proc in procs:
+            proc.wait()
+
+
+def main() -> None:
+    if workers > 1 and worker_index is None:
+        sys.exit(supervise())
+    run()
 
-log.info("Initialization complete")
-log.debug(f"Listening at http://{host}:{port}")
-log.debug(f"Public URL prefix is {public_url}")
 
-try:
-    loop.run_forever()
-except KeyboardInterrupt:
-    loop.run_until_complete(stop())
-except Exception:
-    log.fatal("Fatal error in event loop", exc_info=True)
-    sys.exit(3)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict
+import logging
+import base64
+import json
+import os
+
+from telethon.crypto import AuthKey
+
+log = logging.getLogger(__name__)
+
+
+class AuthKeyFile:
+    """A JSON file of auth keys exported to other DCs, keyed by DC ID.
+
+    The keys are stored along with the ID of the main session's auth key they were exported
+    from, and ignored if the session has been logged in again since.
+    """
+    path: str
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            log.warning(f"Failed to read auth keys from {self.path}", exc_info=True)
+            return {}
+
+    def load(self, main_key: AuthKey) -> Dict[int, AuthKey]:
+        data = self._read()
+        if not main_key or data.get("main_key_id") != main_key.key_id:
+            return {}
+        return {int(dc_id): AuthKey(base64.b64decode(key))
+                for dc_id, key in data.get("keys", {}).items()}
+
+    def save(self, dc_id: int, auth_key: AuthKey, main_key: AuthKey) -> None:
+        data = self._read()
+        if data.get("main_key_id") != main_key.key_id:
+            data = {"main_key_id": main_key.key_id, "keys": {}}
+        data["keys"][str(dc_id)] = base64.b64encode(auth_key.key).decode("ascii")
+        tmp_path = f"{self.path}.tmp"
+        try:
+            # The keys give full access to the account, so don't make the file world-readable
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with open(fd, "w") as file:
+                json.dump(data, file)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            log.warning(f"Failed to save auth key for DC {dc_id} to {self.path}", exc_info=True)
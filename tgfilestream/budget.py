@@ -0,0 +1,74 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Deque, Tuple
+from collections import deque
+import asyncio
+
+
+class MemoryBudget:
+    """A process-wide limit on the bytes of file parts held in memory.
+
+    Parts are reserved when they're requested and released once they've been written to the
+    client. Waiters are served in order, so a large reservation isn't starved by small ones.
+    """
+    loop: asyncio.AbstractEventLoop
+    limit: int
+    reserved: int
+
+    _waiters: Deque[Tuple[int, asyncio.Future]]
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, limit: int) -> None:
+        self.loop = loop
+        self.limit = limit
+        self.reserved = 0
+        self._waiters = deque()
+
+    def try_reserve(self, size: int) -> bool:
+        if self._waiters or self.reserved + size > self.limit:
+            return False
+        self.reserved += size
+        return True
+
+    async def reserve(self, size: int, timeout: float) -> bool:
+        """Reserve bytes, waiting up to ``timeout`` seconds for them to be available."""
+        if self.try_reserve(size):
+            return True
+        fut = self.loop.create_future()
+        self._waiters.append((size, fut))
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            if fut.done():
+                self.release(size)
+            else:
+                self._waiters.remove((size, fut))
+            raise
+        if fut.done():
+            return True
+        self._waiters.remove((size, fut))
+        return False
+
+    def release(self, size: int) -> None:
+        self.reserved -= size
+        while self._waiters:
+            size, fut = self._waiters[0]
+            if self.reserved + size > self.limit:
+                break
+            self._waiters.popleft()
+            self.reserved += size
+            fut.set_result(True)
@@ -0,0 +1,259 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import AsyncGenerator, Callable, Dict, List, Optional, Tuple, Union
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+import hashlib
+import struct
+import zlib
+
+from .cache import FileInfo
+
+Chunk = Union[bytes, memoryview]
+# Downloads a range (start inclusive, end exclusive) of a file like ParallelTransferrer.download
+FetchRange = Callable[[FileInfo, int, int], AsyncGenerator[Tuple[int, memoryview], None]]
+
+local_header_format = struct.Struct("<IHHHHHIIIHH")
+local_extra_format = struct.Struct("<HHQQ")
+descriptor_format = struct.Struct("<IIQQ")
+central_header_format = struct.Struct("<IHHHHHHIIIHHHHHII")
+central_extra_format = struct.Struct("<HHQQQ")
+zip64_end_format = struct.Struct("<IQHHIIQQQQ")
+zip64_locator_format = struct.Struct("<IIQI")
+end_format = struct.Struct("<IHHHHIIH")
+
+# ZIP64, bit 3 (sizes and CRC in a data descriptor after the data) and bit 11 (UTF-8 names)
+zip_version = 45
+zip_flags = 0x0808
+# Unix, regular file with 0644 permissions
+made_by = zip_version | (3 << 8)
+external_attr = 0o100644 << 16
+u16_max = 0xFFFF
+u32_max = 0xFFFFFFFF
+
+
+def _dos_time(date: datetime) -> Tuple[int, int]:
+    if date.year < 1980:
+        return 0, (1 << 5) | 1
+    return ((date.hour << 11) | (date.minute << 5) | (date.second // 2),
+            ((date.year - 1980) << 9) | (date.month << 5) | date.day)
+
+
+class CRCCache:
+    """An LRU cache of the CRC-32 of documents, which is needed for the ZIP metadata."""
+    max_size: int
+    _entries: 'OrderedDict[int, int]'
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def get(self, document_id: int) -> Optional[int]:
+        try:
+            self._entries.move_to_end(document_id)
+            return self._entries[document_id]
+        except KeyError:
+            return None
+
+    def put(self, document_id: int, crc: int) -> None:
+        self._entries[document_id] = crc
+        self._entries.move_to_end(document_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+@dataclass
+class BundleEntry:
+    info: FileInfo
+    name: bytes
+    header_offset: int
+    data_offset: int
+
+    @property
+    def data_end(self) -> int:
+        return self.data_offset + self.info.size
+
+    @property
+    def end(self) -> int:
+        return self.data_end + descriptor_format.size
+
+
+class Bundle:
+    """A stored (uncompressed) ZIP64 archive of Telegram files that is generated on the fly.
+
+    The layout only depends on the names and sizes of the files, so the size of the archive and
+    the location of every file in it are known before anything is downloaded. The CRCs are only
+    needed in the data descriptors and the central directory, which come after the file data,
+    so they're computed as the files are streamed. Ranges that need the CRC of a file that
+    wasn't streamed from the start download the rest of the file to compute it, see
+    :meth:`crc_download_size`.
+    """
+    entries: List[BundleEntry]
+    central_offset: int
+    central_size: int
+    size: int
+    date: datetime
+    crc_cache: CRCCache
+
+    def __init__(self, files: List[FileInfo], crc_cache: CRCCache) -> None:
+        self.crc_cache = crc_cache
+        self.entries = []
+        names: Dict[str, int] = {}
+        offset = 0
+        for info in files:
+            name = info.name
+            if name in names:
+                names[name] += 1
+                stem, dot, ext = name.rpartition(".")
+                name = f"{stem} ({names[name]}).{ext}" if dot else f"{name} ({names[name]})"
+            names.setdefault(name, 0)
+            encoded = name.encode("utf-8")
+            data_offset = (offset + local_header_format.size + len(encoded)
+                           + local_extra_format.size)
+            entry = BundleEntry(info=info, name=encoded, header_offset=offset,
+                                data_offset=data_offset)
+            self.entries.append(entry)
+            offset = entry.end
+        self.central_offset = offset
+        self.central_size = sum(central_header_format.size + len(entry.name)
+                                + central_extra_format.size for entry in self.entries)
+        self.size = (self.central_offset + self.central_size + zip64_end_format.size
+                     + zip64_locator_format.size + end_format.size)
+        self.date = max(info.date for info in files)
+
+    @property
+    def etag(self) -> str:
+        digest = hashlib.sha256(",".join(entry.info.etag for entry in self.entries)
+                                .encode("utf-8"))
+        return f'"{digest.hexdigest()[:32]}"'
+
+    def _local_header(self, entry: BundleEntry) -> bytes:
+        time, date = _dos_time(entry.info.date)
+        return b"".join((
+            local_header_format.pack(0x04034b50, zip_version, zip_flags, 0, time, date, 0,
+                                     u32_max, u32_max, len(entry.name), local_extra_format.size),
+            entry.name,
+            local_extra_format.pack(0x0001, 16, 0, 0),
+        ))
+
+    @staticmethod
+    def _descriptor(entry: BundleEntry, crc: int) -> bytes:
+        return descriptor_format.pack(0x08074b50, crc, entry.info.size, entry.info.size)
+
+    def _central_directory(self, crcs: List[int]) -> bytes:
+        records = []
+        for entry, crc in zip(self.entries, crcs):
+            time, date = _dos_time(entry.info.date)
+            records += (
+                central_header_format.pack(0x02014b50, made_by, zip_version, zip_flags, 0, time,
+                                           date, crc, u32_max, u32_max, len(entry.name),
+                                           central_extra_format.size, 0, 0, 0, external_attr,
+                                           u32_max),
+                entry.name,
+                central_extra_format.pack(0x0001, 24, entry.info.size, entry.info.size,
+                                          entry.header_offset),
+            )
+        count = len(self.entries)
+        zip64_end_offset = self.central_offset + self.central_size
+        records += (
+            zip64_end_format.pack(0x06064b50, zip64_end_format.size - 12, made_by, zip_version,
+                                  0, 0, count, count, self.central_size, self.central_offset),
+            zip64_locator_format.pack(0x07064b50, 0, zip64_end_offset, 1),
+            end_format.pack(0x06054b50, 0, 0, min(count, u16_max), min(count, u16_max),
+                            min(self.central_size, u32_max), min(self.central_offset, u32_max),
+                            0),
+        )
+        return b"".join(records)
+
+    def crc_download_size(self, start: int, end: int) -> int:
+        """Get how many bytes outside of a range are downloaded to compute the CRCs it needs."""
+        size = 0
+        for entry in self.entries:
+            # The descriptor and central directory after the file data need its CRC. The part
+            # of the file before the range has to be downloaded if the CRC isn't cached.
+            if end > entry.data_end and self.crc_cache.get(entry.info.document_id) is None:
+                size += min(max(start - entry.data_offset, 0), entry.info.size)
+        return size
+
+    @staticmethod
+    async def _crc(entry: BundleEntry, fetch: FetchRange, start: int, end: int, crc: int = 0
+                   ) -> int:
+        """Continue the CRC of a file over the bytes from ``start`` to ``end``."""
+        if start < end:
+            body = fetch(entry.info, start, end)
+            try:
+                async for _, chunk in body:
+                    crc = zlib.crc32(chunk, crc)
+            finally:
+                await body.aclose()
+        return crc
+
+    async def _get_crc(self, entry: BundleEntry, fetch: FetchRange) -> int:
+        crc = self.crc_cache.get(entry.info.document_id)
+        if crc is None:
+            crc = await self._crc(entry, fetch, 0, entry.info.size)
+            self.crc_cache.put(entry.info.document_id, crc)
+        return crc
+
+    async def stream(self, start: int, end: int, fetch: FetchRange
+                     ) -> AsyncGenerator[Tuple[int, Chunk], None]:
+        """Generate a range of the archive.
+
+        Yields ``(0, chunk)`` tuples like :meth:`ParallelTransferrer.download` for one range.
+        """
+        for entry in self.entries:
+            if entry.end <= start:
+                continue
+            elif entry.header_offset >= end:
+                break
+            if start < entry.data_offset:
+                header = self._local_header(entry)
+                yield 0, header[max(start - entry.header_offset, 0)
+                                :min(end, entry.data_offset) - entry.header_offset]
+
+            size = entry.info.size
+            data_start = max(start, entry.data_offset) - entry.data_offset
+            data_end = min(end, entry.data_end) - entry.data_offset
+            crc: Optional[int] = None
+            if data_start < data_end:
+                # Compute the CRC while streaming if the whole file is sent or the CRC is needed
+                # later in this response. In the latter case the skipped start of the file has
+                # to be downloaded first.
+                if (self.crc_cache.get(entry.info.document_id) is None and data_end == size
+                        and (data_start == 0 or end > entry.data_end)):
+                    crc = await self._crc(entry, fetch, 0, data_start)
+                body = fetch(entry.info, data_start, data_end)
+                try:
+                    async for _, chunk in body:
+                        if crc is not None:
+                            crc = zlib.crc32(chunk, crc)
+                        yield 0, chunk
+                finally:
+                    await body.aclose()
+                if crc is not None:
+                    self.crc_cache.put(entry.info.document_id, crc)
+
+            if end > entry.data_end:
+                if crc is None:
+                    crc = await self._get_crc(entry, fetch)
+                descriptor = self._descriptor(entry, crc)
+                yield 0, descriptor[max(start - entry.data_end, 0):end - entry.data_end]
+
+        if end > self.central_offset:
+            crcs = [await self._get_crc(entry, fetch) for entry in self.entries]
+            directory = self._central_directory(crcs)
+            yield 0, directory[max(start - self.central_offset, 0):end - self.central_offset]
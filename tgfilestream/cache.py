@@ -0,0 +1,136 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Optional, Tuple, Union, cast
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+import hashlib
+import logging
+import asyncio
+import time
+
+from telethon import TelegramClient, events, utils
+from telethon.tl.custom import Message
+from telethon.tl.types import TypeMessageMedia
+
+from . import metrics
+from .util import unpack_id, get_file_name
+from .config import metadata_cache_size, metadata_cache_ttl
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class FileInfo:
+    media: TypeMessageMedia
+    size: int
+    mime_type: str
+    name: str
+    chat_id: int
+    msg_id: int
+    document_id: int
+    access_hash: int
+    date: datetime
+
+    @property
+    def etag(self) -> str:
+        # The document changes if the message media is edited, so the ID identifies the content.
+        # It's hashed to avoid exposing the access hash.
+        digest = hashlib.sha256(f"{self.document_id}:{self.access_hash}".encode("utf-8"))
+        return f'"{digest.hexdigest()[:32]}"'
+
+    @classmethod
+    def from_message(cls, message: Union[Message, events.NewMessage.Event]) -> 'FileInfo':
+        _, location = utils.get_input_location(message.media)
+        return cls(media=message.media, size=message.file.size, mime_type=message.file.mime_type,
+                   name=get_file_name(message), chat_id=message.chat_id, msg_id=message.id,
+                   document_id=getattr(location, "id", 0),
+                   access_hash=getattr(location, "access_hash", 0),
+                   date=message.edit_date or message.date)
+
+
+class MetadataCache:
+    """An LRU cache of file info for packed file IDs, with a TTL on each entry.
+
+    Concurrent lookups of the same ID share a single ``get_messages`` call.
+    """
+    client: TelegramClient
+    max_size: int
+    ttl: float
+
+    _entries: 'OrderedDict[int, Tuple[float, FileInfo]]'
+    _pending: Dict[int, asyncio.Task]
+
+    def __init__(self, client: TelegramClient, max_size: int = metadata_cache_size,
+                 ttl: float = metadata_cache_ttl) -> None:
+        self.client = client
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._pending = {}
+
+    def get_cached(self, file_id: int) -> Optional[FileInfo]:
+        try:
+            expiry, info = self._entries[file_id]
+        except KeyError:
+            return None
+        if expiry < time.monotonic():
+            del self._entries[file_id]
+            return None
+        self._entries.move_to_end(file_id)
+        return info
+
+    def put(self, file_id: int, info: FileInfo) -> None:
+        if self.max_size <= 0:
+            return
+        self._entries[file_id] = (time.monotonic() + self.ttl, info)
+        self._entries.move_to_end(file_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, file_id: int) -> None:
+        self._entries.pop(file_id, None)
+
+    async def _load(self, file_id: int) -> Optional[FileInfo]:
+        try:
+            peer, msg_id = unpack_id(file_id)
+            if not peer or not msg_id:
+                return None
+            start = time.monotonic()
+            message = cast(Message, await self.client.get_messages(entity=peer, ids=msg_id))
+            metrics.get_messages_time.observe(time.monotonic() - start)
+            if not message or not message.file:
+                return None
+            try:
+                info = FileInfo.from_message(message)
+            except TypeError:
+                # The message has a file that can't be downloaded, like a link preview photo
+                return None
+            self.put(file_id, info)
+            return info
+        finally:
+            del self._pending[file_id]
+
+    async def get(self, file_id: int) -> Optional[FileInfo]:
+        info = self.get_cached(file_id)
+        if info:
+            return info
+        try:
+            task = self._pending[file_id]
+        except KeyError:
+            task = self._pending[file_id] = asyncio.ensure_future(self._load(file_id))
+        # Shield the lookup so that one cancelled request doesn't fail the others waiting for it
+        return await asyncio.shield(task)
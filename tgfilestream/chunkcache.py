@@ -0,0 +1,177 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import List, Optional, Set, Tuple, Union
+from collections import OrderedDict
+import logging
+import asyncio
+import mmap
+import os
+
+from telethon.tl.types import InputDocumentFileLocation, InputPhotoFileLocation
+
+block_size = 512 * 1024
+
+BlockKey = Tuple[str, int]
+
+
+def get_location_key(location: object) -> Optional[str]:
+    """Get a stable cache key for a file location, or ``None`` if it can't be cached."""
+    if isinstance(location, InputDocumentFileLocation):
+        if location.thumb_size:
+            return f"d{location.id}_{location.thumb_size}"
+        return f"d{location.id}"
+    elif isinstance(location, InputPhotoFileLocation):
+        return f"p{location.id}_{location.thumb_size}"
+    return None
+
+
+class ChunkCache:
+    """An on-disk LRU store of file blocks, keyed by location key and block index.
+
+    Blocks are :data:`block_size` bytes long, except for the last block of a file.
+    """
+    log: logging.Logger = logging.getLogger(__name__)
+    loop: asyncio.AbstractEventLoop
+
+    path: str
+    max_size: int
+    size: int
+
+    _blocks: 'OrderedDict[BlockKey, int]'
+    _writing: Set[BlockKey]
+
+    def __init__(self, path: str, max_size: int, loop: asyncio.AbstractEventLoop) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.loop = loop
+        self.size = 0
+        self._blocks = OrderedDict()
+        self._writing = set()
+        os.makedirs(path, exist_ok=True)
+        self._scan()
+
+    def _scan(self) -> None:
+        files = []
+        for entry in os.scandir(self.path):
+            key, _, index = entry.name.rpartition(".")
+            if not key or not index.isdigit():
+                continue
+            stat = entry.stat()
+            files.append((stat.st_atime, (key, int(index)), stat.st_size))
+        for _, block, size in sorted(files):
+            self._blocks[block] = size
+            self.size += size
+        self.log.info(f"Found {len(self._blocks)} cached blocks ({self.size} bytes)")
+        self._evict()
+
+    def _block_path(self, block: BlockKey) -> str:
+        key, index = block
+        return os.path.join(self.path, f"{key}.{index}")
+
+    def has(self, key: str, index: int) -> bool:
+        return (key, index) in self._blocks
+
+    def read(self, key: str, index: int) -> Optional[memoryview]:
+        block = (key, index)
+        if block not in self._blocks:
+            return None
+        try:
+            with open(self._block_path(block), "rb") as file:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self.log.warning(f"Failed to read cached block {key}.{index}", exc_info=True)
+            self._remove(block)
+            return None
+        self._blocks.move_to_end(block)
+        return memoryview(data)
+
+    def read_range(self, key: str, offset: int, length: int) -> Optional[Union[bytes, memoryview]]:
+        """Read a block-aligned part, or a part that fits in one block, if all of it is cached."""
+        first_block = offset // block_size
+        if length <= block_size:
+            data = self.read(key, first_block)
+            if data is None:
+                return None
+            start = offset - first_block * block_size
+            return data[start:start + length]
+        last_block = (offset + length - 1) // block_size
+        if not all(self.has(key, index) for index in range(first_block, last_block + 1)):
+            return None
+        blocks: List[memoryview] = []
+        for index in range(first_block, last_block + 1):
+            data = self.read(key, index)
+            if data is None:
+                return None
+            blocks.append(data)
+            if len(data) < block_size:
+                # A short block is the end of the file
+                break
+        return b"".join(blocks)
+
+    def store_range(self, key: str, offset: int, data: bytes, length: int) -> None:
+        """Store the full blocks of a downloaded part.
+
+        ``length`` is the requested part size. If less data than that was returned, the part
+        reached the end of the file and the last short block is stored too.
+        """
+        if offset % block_size != 0:
+            return
+        first_block = offset // block_size
+        for start in range(0, len(data), block_size):
+            block = data[start:start + block_size]
+            if len(block) == block_size or len(data) < length:
+                self.store(key, first_block + start // block_size, block)
+
+    def store(self, key: str, index: int, data: bytes) -> None:
+        block = (key, index)
+        if block in self._blocks or block in self._writing or len(data) > self.max_size:
+            return
+        self._writing.add(block)
+        asyncio.ensure_future(self._store(block, data), loop=self.loop)
+
+    async def _store(self, block: BlockKey, data: bytes) -> None:
+        try:
+            await self.loop.run_in_executor(None, self._write_file, self._block_path(block), data)
+        except OSError:
+            self.log.warning(f"Failed to write cached block {block[0]}.{block[1]}", exc_info=True)
+            return
+        finally:
+            self._writing.discard(block)
+        self._blocks[block] = len(data)
+        self.size += len(data)
+        self._evict()
+
+    @staticmethod
+    def _write_file(path: str, data: bytes) -> None:
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+
+    def _remove(self, block: BlockKey) -> None:
+        self.size -= self._blocks.pop(block)
+        try:
+            os.unlink(self._block_path(block))
+        except FileNotFoundError:
+            pass
+        except OSError:
+            self.log.warning(f"Failed to remove cached block {block[0]}.{block[1]}",
+                             exc_info=True)
+
+    def _evict(self) -> None:
+        while self.size > self.max_size and self._blocks:
+            block = next(iter(self._blocks))
+            self._remove(block)
@@ -0,0 +1,122 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, List, Optional, Tuple
+from bisect import bisect
+import hashlib
+import logging
+import asyncio
+import hmac
+import time
+
+from aiohttp import web, ClientSession, ClientTimeout, ClientError
+
+from . import metrics
+
+# Set on requests proxied to the instance that owns the file. The value is the cluster secret,
+# which proves that the client IP header was set by a peer.
+cluster_header = "X-TGFS-Cluster"
+client_header = "X-TGFS-Client"
+
+forwarded_headers = ("Range", "If-Range", "If-None-Match", "If-Modified-Since", "User-Agent")
+returned_headers = ("Content-Type", "Content-Length", "Content-Range", "Content-Disposition",
+                    "Accept-Ranges", "ETag", "Last-Modified", "Cache-Control", "Retry-After")
+# How long to serve files locally after a peer fails to respond
+peer_down_time = 30
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.sha256(value.encode("utf-8")).digest()[:8], "big")
+
+
+class Cluster:
+    """Routes each file to one instance of a static set of peers with consistent hashing.
+
+    Each peer is placed on a hash ring many times. A file belongs to the first peer after the
+    file ID on the ring, so adding or removing a peer only moves the files of that peer, and all
+    requests for a file go to one instance and share its caches and read-ahead.
+    """
+    log: logging.Logger = logging.getLogger(__name__)
+    peers: List[str]
+    self_url: str
+    secret: str
+
+    _ring: List[Tuple[int, str]]
+    _ring_keys: List[int]
+    _down_until: Dict[str, float]
+    _session: Optional[ClientSession]
+
+    def __init__(self, peers: List[str], self_url: str, secret: str, replicas: int = 100
+                 ) -> None:
+        self.peers = peers
+        self.self_url = self_url
+        self.secret = secret
+        self._ring = sorted((_hash(f"{peer}#{replica}"), peer)
+                            for peer in peers for replica in range(replicas))
+        self._ring_keys = [key for key, _ in self._ring]
+        self._down_until = {}
+        self._session = None
+
+    def owner(self, file_id: int) -> str:
+        index = bisect(self._ring_keys, _hash(str(file_id))) % len(self._ring)
+        return self._ring[index][1]
+
+    def is_peer_request(self, req: web.Request) -> bool:
+        return hmac.compare_digest(req.headers.get(cluster_header, ""), self.secret)
+
+    async def close(self) -> None:
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    async def proxy(self, req: web.Request, peer: str, client_ip: str
+                    ) -> Optional[web.StreamResponse]:
+        """Forward a request to the given peer.
+
+        Returns ``None`` without sending anything if the peer couldn't be reached, in which
+        case the request should be served locally.
+        """
+        if self._down_until.get(peer, 0) > time.monotonic():
+            return None
+        if not self._session:
+            self._session = ClientSession(timeout=ClientTimeout(sock_connect=5, sock_read=120),
+                                          auto_decompress=False)
+        headers = {name: req.headers[name] for name in forwarded_headers if name in req.headers}
+        headers[cluster_header] = self.secret
+        headers[client_header] = client_ip
+        try:
+            upstream = await self._session.request(req.method, f"{peer}{req.rel_url}",
+                                                   headers=headers, allow_redirects=False)
+        except (ClientError, asyncio.TimeoutError) as e:
+            self.log.warning(f"Failed to proxy request to {peer}, serving locally: {e!r}")
+            self._down_until[peer] = time.monotonic() + peer_down_time
+            return None
+        metrics.cluster_proxied.inc(1, peer)
+        try:
+            resp = web.StreamResponse(status=upstream.status, headers={
+                name: upstream.headers[name] for name in returned_headers
+                if name in upstream.headers})
+            await resp.prepare(req)
+            try:
+                async for chunk in upstream.content.iter_any():
+                    await resp.write(chunk)
+            except (ClientError, asyncio.TimeoutError) as e:
+                self.log.warning(f"Proxied response from {peer} failed: {e!r}")
+                resp.force_close()
+                return resp
+            await resp.write_eof()
+            return resp
+        finally:
+            upstream.release()
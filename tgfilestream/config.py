@@ -13,6 +13,8 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict
+import hashlib
 import sys
 import os
 
@@ -40,14 +42,71 @@ public_url = URL(os.environ.get("PUBLIC_URL", f"http://{host}:{port}"))
 
 session_name = os.environ.get("TG_SESSION_NAME", "tgfilestream")
 
+try:
+    # The number of worker processes to serve HTTP requests with
+    workers = int(os.environ.get("WORKERS", "1"))
+except ValueError:
+    workers = 0
+if workers < 1:
+    print("Please make sure the WORKERS environment variable is a positive integer")
+    sys.exit(1)
+# Set by the supervisor process for each worker when running multiple workers
+worker_index = (int(os.environ["TGFS_WORKER_INDEX"]) if "TGFS_WORKER_INDEX" in os.environ
+                else None)
+
+# Where to store auth keys exported to other DCs. Storing them is disabled if set to empty.
+auth_key_file_path = os.environ.get("TG_AUTH_KEY_FILE", f"{session_name}.authkeys")
+prewarm_connections = bool(os.environ.get("PREWARM_CONNECTIONS"))
+
+# The base URLs of all instances in the cluster, including this one. Each file is served by
+# one of them, chosen by file ID, and the others proxy requests for it there.
+cluster_peers = [peer.strip().rstrip("/")
+                 for peer in os.environ.get("CLUSTER_PEERS", "").split(",") if peer.strip()]
+cluster_self = os.environ.get("CLUSTER_SELF", "").strip().rstrip("/")
+if cluster_peers and cluster_self not in cluster_peers:
+    print("Please make sure the CLUSTER_SELF environment variable is set to the URL of this"
+          " instance in CLUSTER_PEERS")
+    sys.exit(1)
+cluster_secret = os.environ.get("CLUSTER_SECRET") or hashlib.sha256(
+    f"tgfilestream cluster {api_hash}".encode("utf-8")).hexdigest()
+
+# The key for signing download links. Changing it invalidates all signed links.
+link_secret = (os.environ.get("LINK_SECRET")
+               or f"tgfilestream links {api_hash}").encode("utf-8")
+
+# The Cache-Control header of file responses. Links always point to the same content, so
+# responses can be cached for long, but deleting the message won't remove cached copies.
+cache_control = os.environ.get("CACHE_CONTROL", "public, max-age=86400")
+
 log_config = os.environ.get("LOG_CONFIG")
 debug = bool(os.environ.get("DEBUG"))
+enable_metrics = bool(os.environ.get("ENABLE_METRICS"))
+try:
+    # The port to also serve metrics on. With multiple workers, worker N uses this port plus N.
+    metrics_port = int(os.environ.get("METRICS_PORT", "0"))
+except ValueError:
+    print("Please make sure the METRICS_PORT environment variable is an integer")
+    sys.exit(1)
+# A file to write sampled request traces to as JSON lines instead of the main log
+trace_file = os.environ.get("TRACE_FILE")
+
+try:
+    # The fraction of downloads to record a timing trace of
+    trace_sample_rate = float(os.environ.get("TRACE_SAMPLE_RATE", "0"))
+except ValueError:
+    print("Please make sure the TRACE_SAMPLE_RATE environment variable is a number")
+    sys.exit(1)
 
 try:
     # The per-user ongoing request limit
     request_limit = int(os.environ.get("REQUEST_LIMIT", "5"))
+    # The maximum number of clients with ongoing requests
+    max_tracked_clients = int(os.environ.get("MAX_TRACKED_CLIENTS", "100000"))
+    # IPv6 clients in the same subnet of this size share the request limit
+    ipv6_subnet_prefix = int(os.environ.get("IPV6_SUBNET_PREFIX", "64"))
 except ValueError:
-    print("Please make sure the REQUEST_LIMIT environment variable is an integer")
+    print("Please make sure the REQUEST_LIMIT, MAX_TRACKED_CLIENTS and IPV6_SUBNET_PREFIX"
+          " environment variables are integers")
     sys.exit(1)
 
 try:
@@ -57,6 +116,119 @@ except ValueError:
     print("Please make sure the CONNECTION_LIMIT environment variable is an integer")
     sys.exit(1)
 
+try:
+    # The number of connections to keep open to each Telegram DC even when idle
+    connection_min = int(os.environ.get("CONNECTION_MIN", "0"))
+    # Per-DC overrides for the connection limit and minimum, e.g. CONNECTION_LIMIT_DC2=30
+    connection_limits: Dict[int, int] = {}
+    connection_minimums: Dict[int, int] = {}
+    for key, value in os.environ.items():
+        if key.startswith("CONNECTION_LIMIT_DC"):
+            connection_limits[int(key[len("CONNECTION_LIMIT_DC"):])] = int(value)
+        elif key.startswith("CONNECTION_MIN_DC"):
+            connection_minimums[int(key[len("CONNECTION_MIN_DC"):])] = int(value)
+except ValueError:
+    print("Please make sure the CONNECTION_MIN, CONNECTION_LIMIT_DC<n> and CONNECTION_MIN_DC<n>"
+          " environment variables are integers")
+    sys.exit(1)
+
+try:
+    # The number of seconds after which unused connections above the minimum are closed
+    connection_idle_timeout = float(os.environ.get("CONNECTION_IDLE_TIMEOUT", "300"))
+    # The interval in seconds for closing idle connections and checking that the rest are alive
+    connection_check_interval = float(os.environ.get("CONNECTION_CHECK_INTERVAL", "60"))
+except ValueError:
+    print("Please make sure the CONNECTION_IDLE_TIMEOUT and CONNECTION_CHECK_INTERVAL"
+          " environment variables are numbers")
+    sys.exit(1)
+
+try:
+    # The number of file parts to keep in flight for a single download
+    parallel_parts = int(os.environ.get("PARALLEL_PARTS", "4"))
+except ValueError:
+    parallel_parts = 0
+if parallel_parts < 1:
+    print("Please make sure the PARALLEL_PARTS environment variable is a positive integer")
+    sys.exit(1)
+
+try:
+    # How many times a failed part request is retried before the download is aborted
+    part_retries = int(os.environ.get("PART_RETRIES", "5"))
+    # The longest FLOOD_WAIT in seconds that is waited out instead of failing the download
+    max_flood_wait = int(os.environ.get("MAX_FLOOD_WAIT", "30"))
+    # How long in seconds a single part request may take before its connection is dropped
+    part_timeout = float(os.environ.get("PART_TIMEOUT", "30"))
+except ValueError:
+    print("Please make sure the PART_RETRIES, MAX_FLOOD_WAIT and PART_TIMEOUT environment"
+          " variables are numbers")
+    sys.exit(1)
+
+try:
+    # The maximum number of file parts being downloaded or sent at once, shared fairly between
+    # clients. 0 disables the scheduler.
+    fetch_slots = int(os.environ.get("FETCH_SLOTS", "100"))
+    # The maximum download speed of a single client in bytes per second. 0 means unlimited.
+    client_rate_limit = int(os.environ.get("CLIENT_RATE_LIMIT", "0"))
+    # Ranges up to this many bytes are considered interactive and prioritized over bulk reads
+    interactive_range_size = int(os.environ.get("INTERACTIVE_RANGE_SIZE", str(1024 * 1024)))
+    interactive_weight = float(os.environ.get("INTERACTIVE_WEIGHT", "4"))
+except ValueError:
+    print("Please make sure the FETCH_SLOTS, CLIENT_RATE_LIMIT, INTERACTIVE_RANGE_SIZE and"
+          " INTERACTIVE_WEIGHT environment variables are numbers")
+    sys.exit(1)
+
+try:
+    # The maximum amount of memory for file parts being downloaded or sent, in MiB
+    memory_budget = int(os.environ.get("MEMORY_BUDGET", "512")) * 1024 * 1024
+    # How long a request waits for memory or a fetch slot before it's refused with 503
+    admission_timeout = float(os.environ.get("ADMISSION_TIMEOUT", "5"))
+except ValueError:
+    print("Please make sure the MEMORY_BUDGET and ADMISSION_TIMEOUT environment variables are"
+          " numbers")
+    sys.exit(1)
+
+try:
+    # The maximum number of files whose metadata is kept in memory
+    metadata_cache_size = int(os.environ.get("METADATA_CACHE_SIZE", "10000"))
+    # The number of seconds file metadata is kept in memory
+    metadata_cache_ttl = float(os.environ.get("METADATA_CACHE_TTL", "3600"))
+except ValueError:
+    print("Please make sure the METADATA_CACHE_SIZE and METADATA_CACHE_TTL environment variables"
+          " are numbers")
+    sys.exit(1)
+
+# The directory to cache downloaded file blocks in. Caching is disabled if unset.
+chunk_cache_dir = os.environ.get("CHUNK_CACHE_DIR")
+try:
+    # The maximum size of the block cache in mebibytes
+    chunk_cache_size = int(os.environ.get("CHUNK_CACHE_SIZE", "1024")) * 1024 * 1024
+except ValueError:
+    print("Please make sure the CHUNK_CACHE_SIZE environment variable is an integer")
+    sys.exit(1)
+if chunk_cache_dir and worker_index is not None:
+    # Workers don't share the size accounting of the cache, so each one gets its own part of it
+    chunk_cache_dir = os.path.join(chunk_cache_dir, f"worker{worker_index}")
+    chunk_cache_size //= workers
+
+try:
+    # The number of parts to prefetch after a range when a client reads a file sequentially
+    readahead_parts = int(os.environ.get("READAHEAD_PARTS", "4"))
+    # The maximum amount of memory used for prefetched parts in mebibytes
+    readahead_memory = int(os.environ.get("READAHEAD_MEMORY", "64")) * 1024 * 1024
+    # The number of seconds after which idle read-ahead sessions are dropped
+    readahead_timeout = float(os.environ.get("READAHEAD_TIMEOUT", "30"))
+except ValueError:
+    print("Please make sure the READAHEAD_PARTS, READAHEAD_MEMORY and READAHEAD_TIMEOUT"
+          " environment variables are numbers")
+    sys.exit(1)
+
+
+try:
+    # How long to wait in seconds for more files from the same chat before replying with links
+    link_batch_delay = float(os.environ.get("LINK_BATCH_DELAY", "1"))
+except ValueError:
+    print("Please make sure the LINK_BATCH_DELAY environment variable is a number")
+    sys.exit(1)
 
 start_message = os.environ.get("TG_START_MESG", "Send an image or file to get a link to download it")
 group_chat_message = os.environ.get("TG_G_C_MESG", "Sorry. But, I only work in private.")
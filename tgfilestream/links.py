@@ -0,0 +1,155 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import List, Optional, Tuple, Union
+from datetime import datetime, timezone
+import hashlib
+import base64
+import struct
+import hmac
+
+from telethon import events, utils
+from telethon.tl.custom import Message
+from telethon.tl.types import (Document, Photo, PhotoSize, InputDocumentFileLocation,
+                               InputPhotoFileLocation)
+
+from .cache import FileInfo
+from .util import get_file_name, unpack_id
+from .config import link_secret
+
+token_version = 1
+kind_document = 0
+kind_photo = 1
+# version, kind, DC ID, document ID, access hash, size, date
+header_format = struct.Struct(">BBHqqQI")
+# Packed file IDs don't fit in 64 bits
+file_id_length = 9
+mac_length = 16
+# The maximum number of files in a bundle link
+max_bundle_files = 100
+
+
+def _sign(purpose: bytes, payload: bytes, name: str) -> bytes:
+    # The name is in the URL next to the token, so it's signed instead of included in the token.
+    # The purpose keeps file tokens from being accepted as bundle tokens and vice versa.
+    return hmac.new(link_secret, purpose + payload + name.encode("utf-8"),
+                    hashlib.sha256).digest()[:mac_length]
+
+
+def _encode(purpose: bytes, payload: bytes, name: str) -> str:
+    token = payload + _sign(purpose, payload, name)
+    return base64.urlsafe_b64encode(token).rstrip(b"=").decode("ascii")
+
+
+def _decode(purpose: bytes, token: str, name: str) -> Optional[bytes]:
+    try:
+        data = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+    except ValueError:
+        return None
+    payload, mac = data[:-mac_length], data[-mac_length:]
+    if not payload or not hmac.compare_digest(mac, _sign(purpose, payload, name)):
+        return None
+    return payload
+
+
+def _pack_bytes(data: bytes) -> bytes:
+    if len(data) > 255:
+        raise ValueError("field too long")
+    return bytes([len(data)]) + data
+
+
+def create_link_token(file_id: int, message: Union[Message, events.NewMessage.Event]
+                      ) -> Optional[str]:
+    """Create a signed token that contains everything needed to download the file.
+
+    Returns ``None`` if the media can't be described by a token, in which case the plain file ID
+    link should be used.
+    """
+    try:
+        dc_id, location = utils.get_input_location(message.media)
+    except TypeError:
+        return None
+    if isinstance(location, InputDocumentFileLocation):
+        kind = kind_document
+    elif isinstance(location, InputPhotoFileLocation):
+        kind = kind_photo
+    else:
+        return None
+    date = message.edit_date or message.date
+    try:
+        payload = b"".join((
+            header_format.pack(token_version, kind, dc_id, location.id, location.access_hash,
+                               message.file.size, int(date.timestamp())),
+            file_id.to_bytes(file_id_length, "big"),
+            _pack_bytes(location.file_reference),
+            _pack_bytes((message.file.mime_type or "").encode("utf-8")),
+            _pack_bytes(location.thumb_size.encode("utf-8")),
+        ))
+    except (ValueError, OverflowError, struct.error):
+        return None
+    return _encode(b"file", payload, get_file_name(message))
+
+
+def parse_link_token(token: str, name: str) -> Optional[Tuple[int, FileInfo]]:
+    """Verify a link token and build the file info from it.
+
+    Returns the packed file ID of the message, which is needed to refresh the file reference,
+    and the file info, or ``None`` if the token is invalid.
+    """
+    payload = _decode(b"file", token, name)
+    if not payload or len(payload) < header_format.size:
+        return None
+    version, kind, dc_id, doc_id, access_hash, size, timestamp = header_format.unpack_from(
+        payload)
+    if version != token_version:
+        return None
+    pos = header_format.size
+    file_id = int.from_bytes(payload[pos:pos + file_id_length], "big")
+    pos += file_id_length
+    fields = []
+    for _ in range(3):
+        length = payload[pos]
+        fields.append(payload[pos + 1:pos + 1 + length])
+        pos += 1 + length
+    file_reference, mime_type, thumb_size = fields[0], fields[1].decode(), fields[2].decode()
+    date = datetime.fromtimestamp(timestamp, timezone.utc)
+    if kind == kind_photo:
+        media = Photo(id=doc_id, access_hash=access_hash, file_reference=file_reference,
+                      date=date, sizes=[PhotoSize(type=thumb_size, w=0, h=0, size=size)],
+                      dc_id=dc_id)
+    else:
+        media = Document(id=doc_id, access_hash=access_hash, file_reference=file_reference,
+                         date=date, mime_type=mime_type, size=size, dc_id=dc_id, attributes=[])
+    peer, msg_id = unpack_id(file_id)
+    return file_id, FileInfo(media=media, size=size, mime_type=mime_type, name=name,
+                             chat_id=utils.get_peer_id(peer), msg_id=msg_id, document_id=doc_id,
+                             access_hash=access_hash, date=date)
+
+
+def create_bundle_token(file_ids: List[int], name: str) -> str:
+    """Create a signed token for a ZIP bundle of the files with the given packed IDs."""
+    return _encode(b"bundle", bytes([token_version]) + b"".join(
+        file_id.to_bytes(file_id_length, "big") for file_id in file_ids), name)
+
+
+def parse_bundle_token(token: str, name: str) -> Optional[List[int]]:
+    payload = _decode(b"bundle", token, name)
+    if not payload or payload[0] != token_version:
+        return None
+    ids = payload[1:]
+    if not ids or len(ids) % file_id_length or len(ids) > max_bundle_files * file_id_length:
+        return None
+    return [int.from_bytes(ids[pos:pos + file_id_length], "big")
+            for pos in range(0, len(ids), file_id_length)]
@@ -13,9 +13,12 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from logging.handlers import QueueHandler, QueueListener
 import logging
+import atexit
+import queue
 
-from .config import log_config, debug
+from .config import log_config, debug, trace_file
 
 if log_config:
     logging.basicConfig(filename=log_config)
@@ -23,4 +26,25 @@ else:
     logging.basicConfig(level=logging.DEBUG if debug else logging.INFO)
     logging.getLogger("telethon").setLevel(logging.INFO if debug else logging.ERROR)
 
+
+def _move_to_thread(logger: logging.Logger) -> None:
+    # Records are written to the handlers in a background thread, so a slow disk or terminal
+    # doesn't block the event loop. Filtering by level still happens before anything is queued.
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    listener = QueueListener(records, *logger.handlers, respect_handler_level=True)
+    logger.handlers = [QueueHandler(records)]
+    listener.start()
+    atexit.register(listener.stop)
+
+
+trace_log = logging.getLogger("tgfilestream.trace")
+trace_log.setLevel(logging.INFO)
+if trace_file:
+    trace_handler = logging.FileHandler(trace_file)
+    trace_handler.setFormatter(logging.Formatter("%(message)s"))
+    trace_log.addHandler(trace_handler)
+    trace_log.propagate = False
+    _move_to_thread(trace_log)
+_move_to_thread(logging.getLogger())
+
 log = logging.getLogger("tgfilestream")
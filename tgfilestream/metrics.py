@@ -0,0 +1,148 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from bisect import bisect_left
+
+LabelValues = Tuple[str, ...]
+
+registry: List['Metric'] = []
+# Labels added to every sample, like the index of the worker process
+common_labels: Dict[str, str] = {}
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    labels = ",".join(f'{name}="{value}"'
+                      for name, value in (*common_labels.items(), *zip(names, values)))
+    return f"{{{labels}}}" if labels else ""
+
+
+class Metric:
+    type: str = "untyped"
+    name: str
+    help: str
+    labels: Tuple[str, ...]
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        registry.append(self)
+
+    def _samples(self) -> Iterable[str]:
+        raise NotImplementedError()
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.help}",
+                          f"# TYPE {self.name} {self.type}",
+                          *self._samples()])
+
+
+class Counter(Metric):
+    """A counter that is either incremented directly or read from a function when rendered."""
+    type = "counter"
+    values: Dict[LabelValues, float]
+    function: Optional[Callable[[], Dict[LabelValues, float]]]
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                 function: Optional[Callable[[], Dict[LabelValues, float]]] = None) -> None:
+        super().__init__(name, help, labels)
+        self.values = {}
+        self.function = function
+
+    def inc(self, amount: float = 1, *labels: str) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def _samples(self) -> Iterable[str]:
+        if self.function:
+            self.values = self.function()
+        for labels, value in self.values.items():
+            yield f"{self.name}{_format_labels(self.labels, labels)} {value}"
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, amount: float = 1, *labels: str) -> None:
+        self.inc(-amount, *labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+    buckets: Tuple[float, ...]
+    values: Dict[LabelValues, Tuple[List[int], List[float]]]
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...],
+                 labels: Tuple[str, ...] = ()) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        try:
+            counts, total = self.values[labels]
+        except KeyError:
+            counts, total = self.values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def _samples(self) -> Iterable[str]:
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bucket, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                bucket_labels = _format_labels((*self.labels, "le"), (*labels, str(bucket)))
+                yield f"{self.name}_bucket{bucket_labels} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, labels)} {total[0]}"
+            yield f"{self.name}_count{_format_labels(self.labels, labels)} {cumulative}"
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+part_fetch_time = Histogram("tgfilestream_part_fetch_seconds",
+                            "Time taken to download a file part from Telegram", latency_buckets,
+                            labels=("dc",))
+get_messages_time = Histogram("tgfilestream_get_messages_seconds",
+                              "Time taken to look up a message for a file", latency_buckets)
+time_to_first_byte = Histogram("tgfilestream_time_to_first_byte_seconds",
+                               "Time from receiving a request to sending the first body byte",
+                               latency_buckets)
+active_downloads = Gauge("tgfilestream_active_downloads", "Downloads currently in progress")
+bytes_served = Counter("tgfilestream_served_bytes_total", "Response body bytes sent")
+responses = Counter("tgfilestream_responses_total", "HTTP responses sent by status code",
+                    labels=("status",))
+cluster_proxied = Counter("tgfilestream_cluster_proxied_total",
+                          "Requests proxied to the cluster peer that owns the file",
+                          labels=("peer",))
+part_retries = Counter("tgfilestream_part_retries_total",
+                       "Retried part requests by the reason of the failure", labels=("reason",))
+
+# The values of these are read from the ParallelTransferrer
+dc_connections = Gauge("tgfilestream_dc_connections", "Open connections to each DC",
+                       labels=("dc",))
+dc_pending_connections = Gauge("tgfilestream_dc_pending_connections",
+                               "Connections to each DC that are being established",
+                               labels=("dc",))
+connection_users = Gauge("tgfilestream_connection_users",
+                         "Part requests currently using each connection",
+                         labels=("dc", "conn"))
+memory_reserved = Gauge("tgfilestream_memory_reserved_bytes",
+                        "Bytes of the memory budget reserved for file parts")
+parts = Counter("tgfilestream_parts_total", "File parts by where they were read from",
+                labels=("source",))
@@ -13,30 +13,63 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Union, AsyncGenerator, AsyncContextManager, Dict, Optional, List
+from typing import (Union, AsyncGenerator, AsyncContextManager, Dict, Optional, List, Deque, Tuple,
+                    Set, Iterable, Callable, Awaitable)
 from contextlib import asynccontextmanager
+from collections import OrderedDict, deque
 from dataclasses import dataclass
+from functools import partial
 import logging
 import asyncio
+import random
 import math
+import time
 
 from telethon import TelegramClient, utils
 from telethon.crypto import AuthKey
-from telethon.network import MTProtoSender
+from telethon.network import MTProtoSender, Connection as TLConnection
 from telethon.tl.functions.auth import ExportAuthorizationRequest, ImportAuthorizationRequest
+from telethon.tl.functions import PingRequest
 from telethon.tl.functions.upload import GetFileRequest
 from telethon.tl.types import (Document, InputFileLocation, InputDocumentFileLocation,
-                               InputPhotoFileLocation, InputPeerPhotoFileLocation, DcOption)
-from telethon.errors import DcIdInvalidError
+                               InputPhotoFileLocation, InputPeerPhotoFileLocation, DcOption,
+                               InputUserSelf)
+from telethon.tl.functions.users import GetUsersRequest
+from telethon.errors import (DcIdInvalidError, UnauthorizedError, InvalidBufferError, ServerError,
+                             FloodWaitError, FileMigrateError, FileReferenceExpiredError)
 
-from .config import connection_limit
+from . import metrics
+from .authkeys import AuthKeyFile
+from .chunkcache import ChunkCache, get_location_key
+from .readahead import ReadAhead
+from .scheduler import FairScheduler, Flow
+from .budget import MemoryBudget
+from .trace import current_trace
+from .config import (auth_key_file_path, connection_limit, connection_limits, connection_min,
+                     connection_minimums, connection_idle_timeout, connection_check_interval,
+                     parallel_parts, chunk_cache_dir, chunk_cache_size, readahead_parts,
+                     readahead_memory, readahead_timeout, fetch_slots, client_rate_limit,
+                     interactive_range_size, interactive_weight, part_retries, max_flood_wait,
+                     memory_budget, admission_timeout, part_timeout)
 
 TypeLocation = Union[Document, InputDocumentFileLocation, InputPeerPhotoFileLocation,
                      InputFileLocation, InputPhotoFileLocation]
+# Called when the file reference of a download expires to get the file with a fresh one
+RefreshLocation = Callable[[], Awaitable[Optional[TypeLocation]]]
 
 root_log = logging.getLogger(__name__)
 
-if connection_limit > 25:
+# The number of seconds to wait for a pong when checking if an idle connection is alive
+connection_check_timeout = 10
+
+# The part sizes allowed by upload.getFile are the powers of two between 4 KiB and 1 MiB.
+# The offset of each part must be divisible by the part size.
+min_part_size = 4 * 1024
+max_part_size = 1024 * 1024
+# The maximum number of files whose migrated DC is remembered
+max_migrated_files = 1000
+
+if max([connection_limit, *connection_limits.values()]) > 25:
     root_log.warning("The connection limit should not be set above 25 to avoid"
                      " infinite disconnect/reconnect loops")
 
@@ -45,8 +78,42 @@ if connection_limit > 25:
 class Connection:
     log: logging.Logger
     sender: MTProtoSender
-    lock: asyncio.Lock
+    index: int
     users: int = 0
+    last_used: float = 0
+
+
+def get_part_size(length: int) -> int:
+    """Get the smallest allowed part size that covers a range of the given length.
+
+    A range is spread over at most two parts of the returned size, so small ranges (like
+    container header probes) don't download a lot of extra data, while long reads use the
+    largest parts to minimize the number of round-trips.
+    """
+    part_size = min_part_size
+    while part_size < length and part_size < max_part_size:
+        part_size *= 2
+    return part_size
+
+
+def get_ranges_part_size(ranges: List[Tuple[int, int]]) -> int:
+    return get_part_size(max(end - start for start, end in ranges))
+
+
+@dataclass
+class PartFetch:
+    task: asyncio.Task
+    waiters: int = 0
+
+
+@dataclass
+class TransferStats:
+    # Parts downloaded from Telegram
+    parts_fetched: int = 0
+    # Parts that were already being downloaded for another stream
+    parts_deduplicated: int = 0
+    # Parts read from the on-disk block cache
+    parts_cached: int = 0
 
 
 class DCConnectionManager:
@@ -57,36 +124,169 @@ class DCConnectionManager:
     dc_id: int
     dc: Optional[DcOption]
     auth_key: Optional[AuthKey]
+    # Whether the auth key is known to work. Keys loaded from the auth key file are checked
+    # when the first connection is made.
+    auth_key_verified: bool
     connections: List[Connection]
+    auth_key_file: Optional[AuthKeyFile]
+    min_connections: int
+    max_connections: int
 
-    _list_lock: asyncio.Lock
+    _auth_lock: asyncio.Lock
+    _pending: Set[asyncio.Task]
+    _counter: int
+    _maintain_task: Optional[asyncio.Task]
 
-    def __init__(self, client: TelegramClient, dc_id: int) -> None:
+    def __init__(self, client: TelegramClient, dc_id: int,
+                 auth_key_file: Optional[AuthKeyFile] = None) -> None:
         self.log = root_log.getChild(f"dc{dc_id}")
         self.client = client
         self.dc_id = dc_id
         self.auth_key = None
+        self.auth_key_verified = False
+        self.auth_key_file = auth_key_file
         self.connections = []
-        self._list_lock = asyncio.Lock()
+        self.max_connections = connection_limits.get(dc_id, connection_limit)
+        self.min_connections = min(connection_minimums.get(dc_id, connection_min),
+                                   self.max_connections)
+        self._auth_lock = asyncio.Lock()
+        self._pending = set()
+        self._counter = 0
+        self._maintain_task = None
         self.loop = client.loop
         self.dc = None
 
+    def start(self) -> None:
+        if not self._maintain_task:
+            self._maintain_task = self.loop.create_task(self._maintain())
+
+    async def stop(self) -> None:
+        if self._maintain_task:
+            self._maintain_task.cancel()
+            self._maintain_task = None
+        for conn in self.connections[:]:
+            await self._close(conn)
+
     async def _new_connection(self) -> Connection:
         if not self.dc:
             self.dc = await self.client._get_dc(self.dc_id)
+        self._counter += 1
+        index = self._counter
+        if self.auth_key and self.auth_key_verified:
+            return await self._connect(index)
+        # Only one connection exports or checks the auth key, the others wait for it
+        async with self._auth_lock:
+            return await self._connect(index)
+
+    async def _connect(self, index: int) -> Connection:
         sender = MTProtoSender(self.auth_key, self.loop, loggers=self.client._log)
-        index = len(self.connections) + 1
-        conn = Connection(sender=sender, log=self.log.getChild(f"conn{index}"), lock=asyncio.Lock())
-        self.connections.append(conn)
-        async with conn.lock:
-            conn.log.info("Connecting...")
-            connection_info = self.client._connection(self.dc.ip_address, self.dc.port, self.dc.id,
-                                                      loop=self.loop, loggers=self.client._log,
-                                                      proxy=self.client._proxy)
-            await sender.connect(connection_info)
+        conn = Connection(sender=sender, log=self.log.getChild(f"conn{index}"), index=index,
+                          last_used=time.monotonic())
+        conn.log.info("Connecting...")
+        try:
+            await sender.connect(self._connection_info())
+            if self.auth_key and not self.auth_key_verified:
+                await self._verify_auth_key(conn)
             if not self.auth_key:
                 await self._export_auth_key(conn)
-            return conn
+        except BaseException:
+            await conn.sender.disconnect()
+            raise
+        self.connections.append(conn)
+        return conn
+
+    def _start_connecting(self) -> asyncio.Task:
+        task = self.loop.create_task(self._new_connection())
+        self._pending.add(task)
+        task.add_done_callback(self._connect_done)
+        return task
+
+    def _connect_done(self, task: asyncio.Task) -> None:
+        self._pending.discard(task)
+        if not task.cancelled() and task.exception():
+            self.log.warning("Failed to create connection", exc_info=task.exception())
+
+    async def _close(self, conn: Connection) -> None:
+        try:
+            self.connections.remove(conn)
+        except ValueError:
+            return
+        conn.log.info("Disconnecting...")
+        await conn.sender.disconnect()
+
+    def drop(self, conn: Connection) -> None:
+        """Remove a connection that failed from the pool so it isn't picked again."""
+        if conn in self.connections:
+            conn.log.warning("Dropping broken connection")
+            self.loop.create_task(self._close(conn))
+
+    async def _check(self, conn: Connection) -> None:
+        try:
+            if not conn.sender.is_connected():
+                raise ConnectionError("sender is disconnected")
+            await asyncio.wait_for(conn.sender.send(PingRequest(ping_id=random.getrandbits(63))),
+                                   timeout=connection_check_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            conn.log.warning("Health check failed", exc_info=True)
+            await self._close(conn)
+
+    async def _maintain(self) -> None:
+        while True:
+            try:
+                await self._maintain_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.log.exception("Error maintaining connection pool")
+            await asyncio.sleep(connection_check_interval)
+
+    async def _maintain_once(self) -> None:
+        idle_since = time.monotonic() - connection_idle_timeout
+        idle = [conn for conn in self.connections if conn.users == 0]
+        for conn in idle:
+            if len(self.connections) <= self.min_connections:
+                break
+            if conn.last_used < idle_since and conn.users == 0:
+                conn.log.debug("Closing idle connection")
+                await self._close(conn)
+        await asyncio.gather(*[self._check(conn) for conn in idle if conn in self.connections])
+        while len(self.connections) + len(self._pending) < self.min_connections:
+            await self._start_connecting()
+
+    def _connection_info(self) -> TLConnection:
+        return self.client._connection(self.dc.ip_address, self.dc.port, self.dc.id,
+                                       loop=self.loop, loggers=self.client._log,
+                                       proxy=self.client._proxy)
+
+    async def _verify_auth_key(self, conn: Connection) -> None:
+        try:
+            # The first request on a connection has to initialize it, like the import does
+            await asyncio.wait_for(conn.sender.send(self.client._init_with(
+                GetUsersRequest(id=[InputUserSelf()]))), part_timeout)
+            self.auth_key_verified = True
+            return
+        except (ConnectionError, asyncio.TimeoutError):
+            raise
+        except (UnauthorizedError, InvalidBufferError):
+            self.log.info("Stored auth key was rejected, exporting a new one", exc_info=True)
+        except Exception:
+            # Any other failure would repeat on every connection and after every restart, so
+            # a new key is exported instead of keeping one that can't be verified
+            self.log.warning("Failed to verify stored auth key, exporting a new one",
+                             exc_info=True)
+        await conn.sender.disconnect()
+        self.auth_key = None
+        conn.sender = MTProtoSender(None, self.loop, loggers=self.client._log)
+        await conn.sender.connect(self._connection_info())
+
+    def reset_auth_key(self) -> None:
+        """Forget an auth key that stopped working, so the next connection exports a new one."""
+        if self.auth_key and self.dc_id != self.client.session.dc_id:
+            self.log.warning("Auth key was rejected, a new one will be exported")
+            self.auth_key = None
+            self.auth_key_verified = False
 
     async def _export_auth_key(self, conn: Connection) -> None:
         self.log.info(f"Exporting auth to DC {self.dc.id}"
@@ -96,6 +296,7 @@ class DCConnectionManager:
         except DcIdInvalidError:
             self.log.debug("Got DcIdInvalidError")
             self.auth_key = self.client.session.auth_key
+            self.auth_key_verified = True
             conn.sender.auth_key = self.auth_key
             return
         req = self.client._init_with(ImportAuthorizationRequest(
@@ -103,27 +304,36 @@ class DCConnectionManager:
         ))
         await conn.sender.send(req)
         self.auth_key = conn.sender.auth_key
+        self.auth_key_verified = True
+        if self.auth_key_file:
+            self.auth_key_file.save(self.dc_id, self.auth_key, self.client.session.auth_key)
 
     async def _next_connection(self) -> Connection:
-        best_conn: Optional[Connection] = None
-        for conn in self.connections:
-            if not best_conn or conn.users < best_conn.users:
-                best_conn = conn
-        if (not best_conn or best_conn.users > 0) and len(self.connections) < connection_limit:
-            best_conn = await self._new_connection()
-        return best_conn
+        # Nothing in the selection awaits, so a slow handshake doesn't block requests that can
+        # use an existing connection. New connections are created in the background and only
+        # awaited when there's no existing connection to use.
+        while True:
+            best_conn = min(self.connections, key=lambda conn: conn.users, default=None)
+            if best_conn and best_conn.users == 0:
+                return best_conn
+            if len(self.connections) + len(self._pending) < self.max_connections:
+                task = self._start_connecting()
+                if not best_conn:
+                    return await asyncio.shield(task)
+            if best_conn:
+                return best_conn
+            # The pool is empty and at its limit, so wait for one of the pending connections
+            await asyncio.wait(self._pending, return_when=asyncio.FIRST_COMPLETED)
 
     @asynccontextmanager
     async def get_connection(self) -> AsyncContextManager[Connection]:
-        async with self._list_lock:
-            conn: Connection = await asyncio.shield(self._next_connection())
-            # The connection is locked so reconnections don't stack
-            async with conn.lock:
-                conn.users += 1
+        conn = await self._next_connection()
+        conn.users += 1
         try:
             yield conn
         finally:
             conn.users -= 1
+            conn.last_used = time.monotonic()
 
 
 class ParallelTransferrer:
@@ -132,68 +342,368 @@ class ParallelTransferrer:
     loop: asyncio.AbstractEventLoop
 
     dc_managers: Dict[int, DCConnectionManager]
+    auth_key_file: Optional[AuthKeyFile]
+    chunk_cache: Optional[ChunkCache]
+    read_ahead: Optional[ReadAhead]
+    scheduler: Optional[FairScheduler]
+    memory_budget: Optional[MemoryBudget]
+    stats: TransferStats
 
     _counter: int
+    _inflight: Dict[Tuple[str, int, int], PartFetch]
+    # The DCs that files were migrated to with FILE_MIGRATE, by location key
+    _file_dcs: 'OrderedDict[str, int]'
 
     def __init__(self, client: TelegramClient) -> None:
         self.client = client
         self.loop = self.client.loop
         self._counter = 0
-        self.dc_managers = {
-            1: DCConnectionManager(client, 1),
-            2: DCConnectionManager(client, 2),
-            3: DCConnectionManager(client, 3),
-            4: DCConnectionManager(client, 4),
-            5: DCConnectionManager(client, 5),
+        self._inflight = {}
+        self._file_dcs = OrderedDict()
+        self.stats = TransferStats()
+        self.dc_managers = {}
+        self.auth_key_file = AuthKeyFile(auth_key_file_path) if auth_key_file_path else None
+        self.chunk_cache = (ChunkCache(chunk_cache_dir, chunk_cache_size, self.loop)
+                            if chunk_cache_dir else None)
+        metrics.dc_connections.function = lambda: {
+            (str(dc_id),): len(dcm.connections) for dc_id, dcm in self.dc_managers.items()}
+        metrics.dc_pending_connections.function = lambda: {
+            (str(dc_id),): len(dcm._pending) for dc_id, dcm in self.dc_managers.items()}
+        metrics.connection_users.function = lambda: {
+            (str(dc_id), str(conn.index)): conn.users
+            for dc_id, dcm in self.dc_managers.items() for conn in dcm.connections}
+        metrics.parts.function = lambda: {
+            ("telegram",): self.stats.parts_fetched,
+            ("deduplicated",): self.stats.parts_deduplicated,
+            ("cache",): self.stats.parts_cached,
+            ("readahead",): self.read_ahead.hits if self.read_ahead else 0,
         }
+        self.read_ahead = (ReadAhead(self.loop, readahead_parts, max_part_size, readahead_memory,
+                                     readahead_timeout)
+                           if readahead_parts > 0 else None)
+        self.scheduler = (FairScheduler(self.loop, fetch_slots, client_rate_limit, max_part_size)
+                          if fetch_slots > 0 else None)
+        self.memory_budget = (MemoryBudget(self.loop, memory_budget)
+                              if memory_budget > 0 else None)
+        metrics.memory_reserved.function = lambda: {
+            (): self.memory_budget.reserved if self.memory_budget else 0}
 
     def post_init(self) -> None:
-        self.dc_managers[self.client.session.dc_id].auth_key = self.client.session.auth_key
+        if self.auth_key_file:
+            keys = self.auth_key_file.load(self.client.session.auth_key)
+            for dc_id, auth_key in keys.items():
+                self.get_dc_manager(dc_id).auth_key = auth_key
+            if keys:
+                self.log.debug(f"Loaded auth keys for DCs {', '.join(map(str, keys))}")
+        home_dcm = self.get_dc_manager(self.client.session.dc_id)
+        home_dcm.auth_key = self.client.session.auth_key
+        home_dcm.auth_key_verified = True
+
+    async def prewarm(self, dc_ids: Iterable[int]) -> None:
+        """Open a connection to each of the given DCs, exporting or checking auth keys as needed.
+        """
+        async def prewarm_dc(dcm: DCConnectionManager) -> None:
+            try:
+                async with dcm.get_connection():
+                    pass
+            except Exception:
+                dcm.log.warning("Failed to prewarm connection", exc_info=True)
+
+        await asyncio.gather(*[prewarm_dc(self.get_dc_manager(dc_id)) for dc_id in dc_ids])
+
+    async def stop(self) -> None:
+        for dcm in self.dc_managers.values():
+            await dcm.stop()
+
+    def get_dc_manager(self, dc_id: int) -> DCConnectionManager:
+        try:
+            return self.dc_managers[dc_id]
+        except KeyError:
+            dcm = self.dc_managers[dc_id] = DCConnectionManager(self.client, dc_id,
+                                                                self.auth_key_file)
+            dcm.start()
+            return dcm
 
     @property
     def next_index(self) -> int:
         self._counter += 1
         return self._counter
 
-    async def _int_download(self, request: GetFileRequest, first_part: int, last_part: int,
-                            part_count: int, part_size: int, dc_id: int, first_part_cut: int,
-                            last_part_cut: int) -> AsyncGenerator[bytes, None]:
+    async def _send_part_request(self, dcm: DCConnectionManager, location: TypeLocation,
+                                 offset: int, part_size: int) -> bytes:
+        trace = current_trace.get()
+        wait_start = time.monotonic()
+        async with dcm.get_connection() as conn:
+            start = time.monotonic()
+            try:
+                # MTProtoSender never times out by itself, so a half-open connection would
+                # otherwise leave the part, and every stream sharing it, waiting forever
+                result = await asyncio.wait_for(
+                    conn.sender.send(GetFileRequest(location, offset=offset, limit=part_size)),
+                    part_timeout)
+            except (ConnectionError, asyncio.TimeoutError):
+                dcm.drop(conn)
+                raise
+            except UnauthorizedError:
+                dcm.reset_auth_key()
+                dcm.drop(conn)
+                raise
+            duration = time.monotonic() - start
+            metrics.part_fetch_time.observe(duration, str(dcm.dc_id))
+            if trace:
+                trace.add_part(offset, "telegram", dcm.dc_id, start - wait_start, duration)
+        return result.bytes
+
+    async def _download_part(self, dcm: DCConnectionManager, location: TypeLocation,
+                             offset: int, part_size: int, cache_key: Optional[str]) -> bytes:
+        self.stats.parts_fetched += 1
+        attempt = 0
+        while True:
+            try:
+                data = await self._send_part_request(dcm, location, offset, part_size)
+                break
+            except FileMigrateError as e:
+                if attempt >= part_retries:
+                    raise
+                reason, delay = "file_migrate", 0
+                dcm = self.get_dc_manager(e.new_dc)
+                if cache_key:
+                    # Later parts of the file go straight to the new DC
+                    self._file_dcs[cache_key] = e.new_dc
+                    self._file_dcs.move_to_end(cache_key)
+                    while len(self._file_dcs) > max_migrated_files:
+                        self._file_dcs.popitem(last=False)
+            except FloodWaitError as e:
+                if attempt >= part_retries or e.seconds > max_flood_wait:
+                    raise
+                reason, delay = "flood_wait", e.seconds
+            except (ConnectionError, asyncio.TimeoutError, UnauthorizedError, ServerError) as e:
+                if attempt >= part_retries:
+                    raise
+                # The broken connection was dropped, so the retry goes to another one
+                reason = "timeout" if isinstance(e, asyncio.TimeoutError) else "connection"
+                delay = min(0.5 * 2 ** attempt, 10) * random.uniform(0.5, 1)
+            attempt += 1
+            metrics.part_retries.inc(1, reason)
+            trace = current_trace.get()
+            if trace:
+                trace.retries += 1
+            self.log.debug("Retrying part at %d of %s in %.1fs after %s error (attempt %d/%d)",
+                           offset, location, delay, reason, attempt, part_retries)
+            await asyncio.sleep(delay)
+        if cache_key and self.chunk_cache:
+            self.chunk_cache.store_range(cache_key, offset, data, part_size)
+        return data
+
+    async def _fetch_part(self, dcm: DCConnectionManager, location: TypeLocation, offset: int,
+                          part_size: int) -> Union[bytes, memoryview]:
+        cache_key = get_location_key(location)
+        if not cache_key:
+            return await self._download_part(dcm, location, offset, part_size, cache_key)
+        if cache_key in self._file_dcs:
+            dcm = self.get_dc_manager(self._file_dcs[cache_key])
+        if self.read_ahead:
+            data = self.read_ahead.get(cache_key, offset, part_size)
+            if data is not None:
+                trace = current_trace.get()
+                if trace:
+                    trace.add_part(offset, "readahead")
+                return data
+        if self.chunk_cache:
+            data = self.chunk_cache.read_range(cache_key, offset, part_size)
+            if data is not None:
+                self.stats.parts_cached += 1
+                trace = current_trace.get()
+                if trace:
+                    trace.add_part(offset, "cache")
+                return data
+
+        # Streams that need a part that is already being downloaded wait for the same request.
+        # Part sizes are powers of two and parts are aligned to their size, so a smaller part is
+        # always inside one aligned part of the largest size, like a read-ahead prefetch.
+        part_key = (cache_key, offset, part_size)
+        fetch = self._inflight.get(part_key)
+        fetch_offset = offset
+        if not fetch and part_size < max_part_size:
+            fetch_offset = offset - offset % max_part_size
+            fetch = self._inflight.get((cache_key, fetch_offset, max_part_size))
+        if fetch:
+            self.stats.parts_deduplicated += 1
+            trace = current_trace.get()
+            if trace:
+                trace.add_part(offset, "shared")
+        else:
+            fetch_offset = offset
+            fetch = self._inflight[part_key] = PartFetch(task=self.loop.create_task(
+                self._download_part(dcm, location, offset, part_size, cache_key)))
+
+            def remove(_: asyncio.Future) -> None:
+                if self._inflight.get(part_key) is fetch:
+                    del self._inflight[part_key]
+
+            fetch.task.add_done_callback(remove)
+        fetch.waiters += 1
+        try:
+            data = await asyncio.shield(fetch.task)
+        finally:
+            fetch.waiters -= 1
+            if fetch.waiters == 0 and not fetch.task.done():
+                fetch.task.cancel()
+        if fetch_offset != offset:
+            start = offset - fetch_offset
+            return memoryview(data)[start:start + part_size]
+        return data
+
+    def _start_part(self, dcm: DCConnectionManager, location: TypeLocation, offset: int,
+                    part_size: int, flow: Optional[Flow]) -> asyncio.Task:
+        task = self.loop.create_task(self._fetch_part(dcm, location, offset, part_size))
+        if flow:
+            # The slot is only needed while the part is fetched
+            task.add_done_callback(flow.release_part)
+        return task
+
+    @staticmethod
+    def _take_slot(task: asyncio.Task, flow: Flow) -> bool:
+        # The done callback is only removable if it hasn't been scheduled yet, in which case
+        # the slot is still held and can be handed to another task
+        return task.remove_done_callback(flow.release_part) > 0
+
+    async def _int_download(self, location: TypeLocation, ranges: List[Tuple[int, int]],
+                            part_count: int, part_size: int, dc_id: int,
+                            client_id: Optional[str] = None, weight: float = 1,
+                            refresh: Optional[RefreshLocation] = None
+                            ) -> AsyncGenerator[Tuple[int, memoryview], None]:
         log = self.log
+        trace = current_trace.get()
+        dcm = self.get_dc_manager(dc_id)
+        flow = self.scheduler.flow(client_id, weight) if self.scheduler and client_id else None
+        budget = self.memory_budget
+        # The number of requested parts beyond the first one that have memory reserved. The first
+        # one is covered by the reservation made when the request was admitted.
+        extra_parts = 0
+        # Every part that any of the ranges touches is downloaded once, in order
+        parts = sorted({part for start, end in ranges
+                        for part in range(start // part_size, (end - 1) // part_size + 1)})
+        # Parts are requested up to parallel_parts ahead of the one being yielded, each on
+        # whichever pooled connection is least busy, and yielded in order. With a scheduler,
+        # each part also holds a slot until it has been fetched.
+        pending: Deque[asyncio.Task] = deque()
+        next_index = 0
+        range_index = 0
+        refreshed = False
+        metrics.active_downloads.inc()
         try:
-            part = first_part
-            dcm = self.dc_managers[dc_id]
-            async with dcm.get_connection() as conn:
-                log = conn.log
-                while part <= last_part:
-                    result = await conn.sender.send(request)
-                    request.offset += part_size
-                    if part == first_part:
-                        yield result.bytes[first_part_cut:]
-                    elif part == last_part:
-                        yield result.bytes[:last_part_cut]
-                    else:
-                        yield result.bytes
-                    log.debug(f"Part {part}/{last_part} (total {part_count}) downloaded")
-                    part += 1
-                log.debug("Parallel download finished")
+            index = 0
+            while index < len(parts):
+                while next_index < len(parts) and len(pending) < parallel_parts:
+                    if flow:
+                        if not pending:
+                            # Only the first part may time out, which is answered with 503. Once
+                            # the response has started, the download waits for its turn.
+                            timeout = admission_timeout if index == 0 else None
+                            if trace:
+                                wait_start = time.monotonic()
+                                await flow.acquire(part_size, timeout)
+                                trace.slot_wait += time.monotonic() - wait_start
+                            else:
+                                await flow.acquire(part_size, timeout)
+                        elif not flow.try_acquire(part_size):
+                            break
+                    if budget and pending:
+                        # Parts of slow clients wait in the transport buffer, so this also
+                        # pauses fetching for them once the budget runs low
+                        if not budget.try_reserve(part_size):
+                            if flow:
+                                flow.release()
+                            break
+                        extra_parts += 1
+                    pending.append(self._start_part(dcm, location, parts[next_index] * part_size,
+                                                    part_size, flow))
+                    next_index += 1
+                part = parts[index]
+                try:
+                    # Slicing a memoryview doesn't copy the part
+                    data = memoryview(await pending[0])
+                except FileReferenceExpiredError:
+                    media = await refresh() if refresh and not refreshed else None
+                    if not media:
+                        raise
+                    log.debug("File reference expired at part %d, resuming with a new one", part)
+                    refreshed = True
+                    dc_id, location = utils.get_input_location(media)
+                    dcm = self.get_dc_manager(dc_id)
+                    # Request the failed part and the ones after it again with the new reference.
+                    # Parts that were still being fetched pass their scheduler slots on.
+                    requeued = [(part, flow and self._take_slot(task, flow))
+                                for part, task in zip(parts[index:next_index], pending)]
+                    for task in pending:
+                        task.cancel()
+                    pending.clear()
+                    for requeued_part, slot in requeued:
+                        pending.append(self._start_part(dcm, location, requeued_part * part_size,
+                                                        part_size, flow if slot else None))
+                    continue
+                pending.popleft()
+                refreshed = False
+                # Yield the slices of each range that this part covers. The ranges are sorted
+                # and don't overlap, so each one is yielded fully before the next one starts.
+                part_start = part * part_size
+                part_end = part_start + part_size
+                while range_index < len(ranges):
+                    start, end = ranges[range_index]
+                    if start >= part_end:
+                        break
+                    cut_start = max(start - part_start, 0)
+                    cut_end = min(end, part_end) - part_start
+                    yield range_index, data[cut_start:cut_end]
+                    if end > part_end:
+                        break
+                    range_index += 1
+                if extra_parts:
+                    budget.release(part_size)
+                    extra_parts -= 1
+                log.debug("Part %d (total %d) downloaded", part, part_count)
+                index += 1
+            log.debug("Parallel download finished")
         except (GeneratorExit, StopAsyncIteration, asyncio.CancelledError):
             log.debug("Parallel download interrupted")
             raise
         except Exception:
             log.debug("Parallel download errored", exc_info=True)
+            raise
+        finally:
+            metrics.active_downloads.dec()
+            for task in pending:
+                task.cancel()
+            if flow:
+                flow.close()
+            if extra_parts:
+                budget.release(extra_parts * part_size)
+
+    def download(self, file: TypeLocation, file_size: int, ranges: List[Tuple[int, int]],
+                 client_id: Optional[str] = None, refresh: Optional[RefreshLocation] = None,
+                 part_size: Optional[int] = None) -> AsyncGenerator[Tuple[int, memoryview], None]:
+        """Download byte ranges of a file.
 
-    def download(self, file: TypeLocation, file_size: int, offset: int, limit: int
-                 ) -> AsyncGenerator[bytes, None]:
+        The ranges are (start inclusive, end exclusive) tuples that must be sorted and must not
+        overlap. Yields the index of the range and the next chunk of it. The part size defaults
+        to :func:`get_ranges_part_size` of the ranges. If there's a memory budget, the caller
+        must have reserved one part for the download.
+        """
         dc_id, location = utils.get_input_location(file)
-        part_size = 512 * 1024
-        first_part_cut = offset % part_size
-        first_part = math.floor(offset / part_size)
-        last_part_cut = part_size - (limit % part_size)
-        last_part = math.ceil(limit / part_size)
+        cache_key = get_location_key(location)
+        if self.read_ahead and client_id and cache_key and len(ranges) == 1:
+            offset, limit = ranges[0]
+            self.read_ahead.observe(client_id, cache_key, file_size, offset, limit,
+                                    partial(self._fetch_part, self.get_dc_manager(dc_id), location))
+        total = sum(end - start for start, end in ranges)
+        part_size = part_size or get_ranges_part_size(ranges)
         part_count = math.ceil(file_size / part_size)
-        self.log.debug(f"Starting parallel download: chunks {first_part}-{last_part}"
-                       f" of {part_count} {location!s}")
-        request = GetFileRequest(location, offset=first_part * part_size, limit=part_size)
+        self.log.debug("Starting parallel download: %d ranges from %d to %d of %d chunks"
+                       " (%d bytes each) %s", len(ranges), ranges[0][0] // part_size,
+                       (ranges[-1][1] - 1) // part_size, part_count, part_size, location)
+        # Small ranges are usually seeks or metadata reads that a player is waiting for
+        weight = interactive_weight if total <= interactive_range_size else 1
 
-        return self._int_download(request, first_part, last_part, part_count, part_size, dc_id,
-                                  first_part_cut, last_part_cut)
+        return self._int_download(location, ranges, part_count, part_size, dc_id, client_id,
+                                  weight, refresh)
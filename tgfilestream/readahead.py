@@ -0,0 +1,154 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple, Union
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import logging
+import asyncio
+import time
+
+Buffer = Union[bytes, memoryview]
+FetchPart = Callable[[int, int], Awaitable[Buffer]]
+PartKey = Tuple[str, int]
+
+
+@dataclass
+class ReadAheadSession:
+    key: str
+    # The end of the last range requested in this session
+    end: int
+    last_seen: float
+    tasks: Set[asyncio.Task] = field(default_factory=set)
+    offsets: Set[int] = field(default_factory=set)
+
+
+class ReadAhead:
+    """Prefetches the parts after the end of a range when a client reads a file sequentially.
+
+    Prefetched parts are kept in a memory buffer shared by all sessions. The buffer is limited
+    to ``max_memory`` bytes and drops the least recently used parts when it's full. Sessions
+    that haven't made a request in ``timeout`` seconds are cancelled and their parts dropped.
+    """
+    log: logging.Logger = logging.getLogger(__name__)
+    loop: asyncio.AbstractEventLoop
+
+    parts: int
+    part_size: int
+    max_memory: int
+    timeout: float
+
+    size: int
+    hits: int
+
+    _buffer: 'OrderedDict[PartKey, Buffer]'
+    _sessions: Dict[Tuple[str, str], ReadAheadSession]
+    _last_expire: float
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, parts: int, part_size: int,
+                 max_memory: int, timeout: float) -> None:
+        self.loop = loop
+        self.parts = parts
+        self.part_size = part_size
+        self.max_memory = max_memory
+        self.timeout = timeout
+        self.size = 0
+        self.hits = 0
+        self._buffer = OrderedDict()
+        self._sessions = {}
+        self._last_expire = 0
+
+    def get(self, key: str, offset: int, length: int) -> Optional[Buffer]:
+        """Get a part from the buffer. The part must not cross a :attr:`part_size` boundary."""
+        start = offset % self.part_size
+        try:
+            data = self._buffer[(key, offset - start)]
+        except KeyError:
+            return None
+        if start >= len(data):
+            return None
+        self._buffer.move_to_end((key, offset - start))
+        self.hits += 1
+        return memoryview(data)[start:start + length]
+
+    def _put(self, key: str, offset: int, data: Buffer) -> None:
+        if (key, offset) in self._buffer:
+            return
+        self._buffer[(key, offset)] = data
+        self.size += len(data)
+        while self.size > self.max_memory and self._buffer:
+            _, old_data = self._buffer.popitem(last=False)
+            self.size -= len(old_data)
+
+    def _drop(self, key: str, offset: int) -> None:
+        try:
+            self.size -= len(self._buffer.pop((key, offset)))
+        except KeyError:
+            pass
+
+    def _expire_sessions(self) -> None:
+        now = time.monotonic()
+        if now - self._last_expire < 1:
+            return
+        self._last_expire = now
+        expiry = now - self.timeout
+        for session_key, session in list(self._sessions.items()):
+            if session.last_seen < expiry:
+                del self._sessions[session_key]
+                for task in session.tasks:
+                    task.cancel()
+                for offset in session.offsets:
+                    self._drop(session.key, offset)
+
+    def observe(self, client_id: str, key: str, file_size: int, offset: int, limit: int,
+                fetch: FetchPart) -> None:
+        """Record a range request and start prefetching if it continues the previous one."""
+        self._expire_sessions()
+        now = time.monotonic()
+        try:
+            session = self._sessions[(client_id, key)]
+        except KeyError:
+            self._sessions[(client_id, key)] = ReadAheadSession(key=key, end=limit,
+                                                                last_seen=now)
+            return
+        sequential = abs(offset - session.end) <= self.part_size
+        session.end = limit
+        session.last_seen = now
+        if not sequential or limit >= file_size:
+            return
+        # Earlier prefetches are left running, as they're likely for the range that was just
+        # requested and the request will wait for them rather than fetching the parts again.
+        task = self.loop.create_task(self._prefetch(session, file_size, limit, fetch))
+        session.tasks.add(task)
+        task.add_done_callback(session.tasks.discard)
+        self.loop.call_later(self.timeout + 1, self._expire_sessions)
+
+    async def _prefetch(self, session: ReadAheadSession, file_size: int, start: int,
+                        fetch: FetchPart) -> None:
+        start -= start % self.part_size
+        offsets = [offset for offset in range(start, start + self.parts * self.part_size,
+                                              self.part_size)
+                   if offset < file_size and (session.key, offset) not in self._buffer]
+
+        async def fetch_one(offset: int) -> None:
+            self._put(session.key, offset, await fetch(offset, self.part_size))
+            session.offsets.add(offset)
+
+        try:
+            await asyncio.gather(*[fetch_one(offset) for offset in offsets])
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.log.debug(f"Prefetching {session.key} from {start} failed", exc_info=True)
@@ -0,0 +1,195 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, List, Optional, Tuple
+from dataclasses import dataclass
+import asyncio
+import heapq
+import time
+
+
+class SlotTimeoutError(Exception):
+    """Raised when a part waits longer than the timeout for a slot."""
+
+
+@dataclass
+class ClientState:
+    # The virtual finish time of the client's last queued part
+    finish: float = 0
+    flows: int = 0
+    # Token bucket for the per-client byte rate limit
+    tokens: float = 0
+    last_refill: float = 0
+
+
+class Flow:
+    """The part slots of a single download."""
+    scheduler: 'FairScheduler'
+    client_id: str
+    state: ClientState
+    weight: float
+    held: int
+
+    def __init__(self, scheduler: 'FairScheduler', client_id: str, state: ClientState,
+                 weight: float) -> None:
+        self.scheduler = scheduler
+        self.client_id = client_id
+        self.state = state
+        self.weight = weight
+        self.held = 0
+
+    async def acquire(self, size: int, timeout: Optional[float] = None) -> None:
+        await self.scheduler._acquire(self, size, timeout)
+        self.held += 1
+
+    def try_acquire(self, size: int) -> bool:
+        if self.scheduler._try_acquire(self, size):
+            self.held += 1
+            return True
+        return False
+
+    def release(self) -> None:
+        if self.held > 0:
+            self.held -= 1
+            self.scheduler._release()
+
+    def release_part(self, _: asyncio.Future) -> None:
+        self.release()
+
+    def close(self) -> None:
+        while self.held > 0:
+            self.release()
+        self.scheduler._close(self)
+
+
+class FairScheduler:
+    """Shares a fixed number of part slots between clients with weighted fair queuing.
+
+    A slot is held from the moment a part is requested until it has been fetched, so the slots
+    limit the part fetches in progress. Fetched parts that are waiting to be written to the
+    client don't hold a slot, so clients that stop reading can't starve the others; the memory
+    they use is bounded by the memory budget instead. Each queued part gets a
+    virtual finish time of ``max(virtual time, client's last finish) + size / weight``, and free
+    slots go to the part with the lowest finish time. A client with many parallel downloads
+    therefore gets the same share as a client with one, and flows with a higher weight (small
+    interactive ranges) are served before bulk transfers.
+    """
+    loop: asyncio.AbstractEventLoop
+    slots: int
+    free: int
+    rate_limit: int
+    burst: int
+
+    _clients: Dict[str, ClientState]
+    _queue: List[Tuple[float, int, float, asyncio.Future]]
+    _virtual_time: float
+    _counter: int
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, slots: int, rate_limit: int,
+                 burst: int) -> None:
+        self.loop = loop
+        self.slots = slots
+        self.free = slots
+        self.rate_limit = rate_limit
+        self.burst = max(rate_limit, burst)
+        self._clients = {}
+        self._queue = []
+        self._virtual_time = 0
+        self._counter = 0
+
+    def flow(self, client_id: str, weight: float = 1) -> Flow:
+        try:
+            state = self._clients[client_id]
+        except KeyError:
+            state = self._clients[client_id] = ClientState(tokens=self.burst,
+                                                           last_refill=time.monotonic())
+        state.flows += 1
+        return Flow(self, client_id, state, weight)
+
+    def _close(self, flow: Flow) -> None:
+        flow.state.flows -= 1
+        if flow.state.flows <= 0:
+            self._clients.pop(flow.client_id, None)
+
+    def _refill(self, state: ClientState) -> None:
+        now = time.monotonic()
+        state.tokens = min(self.burst, state.tokens + (now - state.last_refill) * self.rate_limit)
+        state.last_refill = now
+
+    async def _throttle(self, state: ClientState, size: int) -> None:
+        if not self.rate_limit:
+            return
+        self._refill(state)
+        state.tokens -= size
+        if state.tokens < 0:
+            await asyncio.sleep(-state.tokens / self.rate_limit)
+
+    def _tag(self, flow: Flow, size: int) -> Tuple[float, float]:
+        start = max(self._virtual_time, flow.state.finish)
+        flow.state.finish = start + size / flow.weight
+        return start, flow.state.finish
+
+    def _has_waiters(self) -> bool:
+        # Waiters that timed out or were cancelled stay in the heap until they reach the top
+        while self._queue and self._queue[0][3].done():
+            heapq.heappop(self._queue)
+        return bool(self._queue)
+
+    def _try_acquire(self, flow: Flow, size: int) -> bool:
+        if self.free <= 0 or self._has_waiters():
+            return False
+        if self.rate_limit:
+            self._refill(flow.state)
+            if flow.state.tokens < size:
+                return False
+            flow.state.tokens -= size
+        start, _ = self._tag(flow, size)
+        self._virtual_time = start
+        self.free -= 1
+        return True
+
+    async def _acquire(self, flow: Flow, size: int, timeout: Optional[float]) -> None:
+        await self._throttle(flow.state, size)
+        start, finish = self._tag(flow, size)
+        if self.free > 0 and not self._has_waiters():
+            self._virtual_time = start
+            self.free -= 1
+            return
+        fut = self.loop.create_future()
+        self._counter += 1
+        heapq.heappush(self._queue, (finish, self._counter, start, fut))
+        try:
+            await asyncio.wait((fut,), timeout=timeout)
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # The slot was granted right as the waiter was cancelled, pass it on
+                self._release()
+            else:
+                fut.cancel()
+            raise
+        if not fut.done():
+            # Cancelled waiters are skipped when slots are handed out
+            fut.cancel()
+            raise SlotTimeoutError()
+
+    def _release(self) -> None:
+        self.free += 1
+        while self.free > 0 and self._queue:
+            _, _, start, fut = heapq.heappop(self._queue)
+            if fut.done():
+                continue
+            self._virtual_time = start
+            self.free -= 1
+            fut.set_result(None)
@@ -13,25 +13,92 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.'
+from typing import Dict, List, Optional, Set
+from dataclasses import dataclass, field
 import logging
+import asyncio
 
 from telethon import TelegramClient, events
+from telethon.sessions import SQLiteSession, StringSession
 
 from .paralleltransfer import ParallelTransferrer
+from .cache import MetadataCache, FileInfo
+from .links import create_link_token, create_bundle_token, max_bundle_files
 from .config import (
     session_name,
+    worker_index,
     api_id,
     api_hash,
     public_url,
     start_message,
-    group_chat_message
+    group_chat_message,
+    link_batch_delay
 )
 from .util import pack_id, get_file_name
 
 log = logging.getLogger(__name__)
 
-client = TelegramClient(session_name, api_id, api_hash)
+if worker_index:
+    # Only the first worker writes to the session file. The others use an in-memory copy so
+    # that they don't fight over the SQLite database.
+    _file_session = SQLiteSession(session_name)
+    session = StringSession(StringSession.save(_file_session))
+    _file_session.close()
+else:
+    session = session_name
+# Updates are delivered to any session using the auth key, so the other workers must not ask
+# for them, or bot messages could end up in a worker that ignores them.
+client = TelegramClient(session, api_id, api_hash, receive_updates=not worker_index)
 transfer = ParallelTransferrer(client)
+file_cache = MetadataCache(client)
+
+# The maximum total length of the links in one reply, which keeps replies well below the
+# Telegram message length limit
+max_batch_length = 3000
+# How much each file adds to the bundle link of a batch
+bundle_link_length_per_file = 12
+
+
+@dataclass
+class LinkBatch:
+    reply_to: events.NewMessage.Event
+    links: List[str] = field(default_factory=list)
+    file_ids: List[int] = field(default_factory=list)
+    length: int = 0
+    timer: Optional[asyncio.TimerHandle] = None
+
+
+link_batches: Dict[int, LinkBatch] = {}
+# The event loop only keeps weak references to tasks, so replies being sent are kept here
+_sending: Set[asyncio.Task] = set()
+
+
+async def send_links(batch: LinkBatch) -> None:
+    evt = batch.reply_to
+    if len(batch.links) == 1:
+        url = batch.links[0]
+        text = f"Link to download file: [{url}]({url})"
+    else:
+        text = "Links to download files:\n" + "\n".join(f"[{url}]({url})" for url in batch.links)
+        name = f"files_{evt.date.strftime('%Y-%m-%d_%H:%M:%S')}.zip"
+        bundle_url = public_url / "bundle" / create_bundle_token(batch.file_ids, name) / name
+        text += f"\n\nAll files as a ZIP: [{bundle_url}]({bundle_url})"
+    try:
+        await evt.reply(text)
+    except Exception:
+        log.exception(f"Failed to send {len(batch.links)} links to {evt.chat_id}")
+        return
+    log.info(f"Replied with {len(batch.links)} links to {evt.from_id} in {evt.chat_id}")
+
+
+def flush_links(chat_id: int) -> None:
+    batch = link_batches.pop(chat_id, None)
+    if batch:
+        if batch.timer:
+            batch.timer.cancel()
+        task = asyncio.ensure_future(send_links(batch))
+        _sending.add(task)
+        task.add_done_callback(_sending.discard)
 
 
 @client.on(events.NewMessage)
@@ -39,10 +106,34 @@ async def handle_message(evt: events.NewMessage.Event) -> None:
     if not evt.is_private:
         await evt.reply(group_chat_message)
         return
-    if not evt.file:
+    try:
+        info = FileInfo.from_message(evt) if evt.file else None
+    except TypeError:
+        # Media like link preview photos has a file but can't be downloaded
+        info = None
+    if not info:
         await evt.reply(start_message)
         return
-    url = public_url / str(pack_id(evt)) / get_file_name(evt)
-    await evt.reply(f"Link to download file: [{url}]({url})")
-    log.info(f"Replied with link for {evt.id} to {evt.from_id} in {evt.chat_id}")
+    file_id = pack_id(evt)
+    # The first request for the link usually comes right after this, so save it the lookup
+    file_cache.put(file_id, info)
+    token = create_link_token(file_id, evt)
+    name = get_file_name(evt)
+    url = str(public_url / "f" / token / name if token else public_url / str(file_id) / name)
     log.debug(f"Link to {evt.id} in {evt.chat_id}: {url}")
+    if link_batch_delay <= 0:
+        await send_links(LinkBatch(reply_to=evt, links=[url], file_ids=[file_id]))
+        return
+    # Files sent or forwarded together (e.g. albums) are answered with a single reply
+    batch = link_batches.get(evt.chat_id)
+    link_length = len(url) + bundle_link_length_per_file
+    if batch and (batch.length + link_length > max_batch_length
+                  or len(batch.file_ids) >= max_bundle_files):
+        flush_links(evt.chat_id)
+        batch = None
+    if not batch:
+        batch = link_batches[evt.chat_id] = LinkBatch(reply_to=evt)
+        batch.timer = client.loop.call_later(link_batch_delay, flush_links, evt.chat_id)
+    batch.links.append(url)
+    batch.file_ids.append(file_id)
+    batch.length += link_length
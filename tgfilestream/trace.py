@@ -0,0 +1,124 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Dict, List, Optional
+from contextvars import ContextVar
+import logging
+import random
+import time
+import json
+
+from .config import trace_sample_rate
+
+trace_log = logging.getLogger("tgfilestream.trace")
+# Writes to the client that take longer than this many seconds are counted as stalls
+stall_threshold = 0.01
+# The maximum number of parts listed in a trace, so traces of huge files stay readable
+max_trace_parts = 1000
+
+
+class Trace:
+    """Timings of a single sampled download, logged as one JSON object when it finishes.
+
+    The trace of the current request is stored in :data:`current_trace`, so the part fetches
+    that the request starts record into it without passing it around. Parts fetched for
+    another stream that this one is waiting for are attributed to the stream that started them.
+    """
+    start: float
+    info: Dict[str, Any]
+    lookup: float
+    admission_wait: float
+    slot_wait: float
+    parts: List[Dict[str, Any]]
+    dropped_parts: int
+    retries: int
+    writes: int
+    write_time: float
+    stalls: int
+    stall_time: float
+    longest_stall: float
+
+    def __init__(self, **info: Any) -> None:
+        self.start = time.monotonic()
+        self.info = info
+        self.lookup = 0
+        self.admission_wait = 0
+        self.slot_wait = 0
+        self.parts = []
+        self.dropped_parts = 0
+        self.retries = 0
+        self.writes = 0
+        self.write_time = 0
+        self.stalls = 0
+        self.stall_time = 0
+        self.longest_stall = 0
+
+    def add_part(self, offset: int, source: str, dc_id: Optional[int] = None,
+                 connection_wait: float = 0, fetch: float = 0) -> None:
+        if len(self.parts) >= max_trace_parts:
+            self.dropped_parts += 1
+            return
+        part: Dict[str, Any] = {"offset": offset, "source": source}
+        if dc_id is not None:
+            part["dc"] = dc_id
+            part["connection_wait"] = round(connection_wait, 6)
+            part["fetch"] = round(fetch, 6)
+        self.parts.append(part)
+
+    def add_write(self, duration: float) -> None:
+        self.writes += 1
+        self.write_time += duration
+        if duration > stall_threshold:
+            self.stalls += 1
+            self.stall_time += duration
+            self.longest_stall = max(self.longest_stall, duration)
+
+    def finish(self, status: int, length: int, written: int,
+               first_byte: Optional[float]) -> None:
+        trace_log.info("%s", json.dumps({
+            **self.info,
+            "status": status,
+            "length": length,
+            "written": written,
+            "duration": round(time.monotonic() - self.start, 6),
+            "time_to_first_byte": round(first_byte, 6) if first_byte is not None else None,
+            "lookup": round(self.lookup, 6),
+            "admission_wait": round(self.admission_wait, 6),
+            "slot_wait": round(self.slot_wait, 6),
+            "retries": self.retries,
+            "writes": self.writes,
+            "write_time": round(self.write_time, 6),
+            "write_stalls": self.stalls,
+            "write_stall_time": round(self.stall_time, 6),
+            "longest_write_stall": round(self.longest_stall, 6),
+            "parts": self.parts,
+            "dropped_parts": self.dropped_parts,
+        }))
+
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+
+
+def start_trace(**info: Any) -> Optional[Trace]:
+    """Start tracing the current request if it's picked by the sample rate.
+
+    Does nothing when tracing is disabled, so the context variable stays ``None``.
+    """
+    if not trace_sample_rate:
+        return None
+    # Requests on a keep-alive connection may share a context, so always replace the trace
+    trace = Trace(**info) if random.random() < trace_sample_rate else None
+    current_trace.set(trace)
+    return trace
@@ -0,0 +1,76 @@
+# tgfilestream - A Telegram bot that can stream Telegram files to users over HTTP.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Optional
+import ipaddress
+import logging
+
+
+class RequestTracker:
+    """Counts the ongoing requests of each client.
+
+    Clients are only stored while they have requests in progress, so memory use is bounded by
+    the number of concurrently active clients rather than every address ever seen, and
+    ``max_clients`` caps even that. IPv6 addresses are grouped by ``ipv6_prefix``, as a single
+    user usually gets a whole /64 to pick addresses from.
+    """
+    log: logging.Logger = logging.getLogger(__name__)
+    limit: int
+    max_clients: int
+    ipv6_prefix: int
+    ongoing: Dict[str, int]
+
+    def __init__(self, limit: int, max_clients: int, ipv6_prefix: int) -> None:
+        self.limit = limit
+        self.max_clients = max_clients
+        self.ipv6_prefix = ipv6_prefix
+        self.ongoing = {}
+
+    def client_key(self, ip: str) -> str:
+        # X-Forwarded-For may contain the whole proxy chain, the first entry is the client
+        ip = ip.split(",", 1)[0].strip()
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            return ip
+        if isinstance(addr, ipaddress.IPv6Address):
+            if addr.ipv4_mapped:
+                return str(addr.ipv4_mapped)
+            return str(ipaddress.IPv6Network((addr, self.ipv6_prefix), strict=False))
+        return str(addr)
+
+    def acquire(self, ip: str) -> Optional[str]:
+        """Start a request from the given IP.
+
+        Returns the client key that must be passed to :meth:`release` when the request is
+        done, or ``None`` if the client has too many ongoing requests.
+        """
+        key = self.client_key(ip)
+        count = self.ongoing.get(key, 0)
+        if count >= self.limit:
+            return None
+        elif count == 0 and len(self.ongoing) >= self.max_clients:
+            self.log.warning(f"Refusing request from {key}: tracking {len(self.ongoing)}"
+                             " clients already")
+            return None
+        self.ongoing[key] = count + 1
+        return key
+
+    def release(self, key: str) -> None:
+        count = self.ongoing.get(key, 0) - 1
+        if count > 0:
+            self.ongoing[key] = count
+        else:
+            self.ongoing.pop(key, None)
@@ -13,7 +13,7 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Tuple, Union
+from typing import List, Optional, Tuple, Union
 
 from telethon import events
 from telethon.tl.custom import Message
@@ -22,6 +22,9 @@ from aiohttp import web
 
 from .config import trust_headers
 
+# The maximum number of ranges in a single request after merging overlapping ones
+max_ranges = 64
+
 pack_bits = 32
 pack_bit_mask = (1 << pack_bits) - 1
 
@@ -72,3 +75,50 @@ def get_requester_ip(req: web.Request) -> str:
     peername = req.transport.get_extra_info('peername')
     if peername is not None:
         return peername[0]
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[List[Tuple[int, int]]]:
+    """Parse a Range header into a list of (start inclusive, end exclusive) byte ranges.
+
+    Returns ``None`` if there's no header or it should be ignored, in which case the whole file
+    is served. The ranges are sorted and overlapping or adjacent ranges are merged. Raises
+    ValueError if none of the ranges are satisfiable.
+    """
+    if not header:
+        return None
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    ranges = []
+    for spec in specs.split(","):
+        first, sep, last = spec.strip().partition("-")
+        try:
+            if not sep:
+                return None
+            elif not first:
+                # Suffix range, i.e. the last N bytes
+                length = int(last)
+                if length > 0 and size > 0:
+                    ranges.append((max(size - length, 0), size))
+                continue
+            start = int(first)
+            end = int(last) + 1 if last else size
+        except ValueError:
+            return None
+        if start < 0 or (last and end <= start):
+            return None
+        elif start < size:
+            ranges.append((start, min(end, size)))
+    if not ranges:
+        raise ValueError("no satisfiable ranges")
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        prev_start, prev_end = merged[-1]
+        if start <= prev_end:
+            merged[-1] = (prev_start, max(prev_end, end))
+        else:
+            merged.append((start, end))
+    if len(merged) > max_ranges:
+        raise ValueError("too many ranges")
+    return merged
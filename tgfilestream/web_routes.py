@@ -13,78 +13,398 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Dict, cast
-from collections import defaultdict
+from typing import AsyncGenerator, Awaitable, Callable, Dict, List, Optional, Tuple
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
 import logging
+import asyncio
+import secrets
+import time
 
-from telethon.tl.custom import Message
 from aiohttp import web
+from telethon.tl.types import TypeMessageMedia
 
-from .util import unpack_id, get_file_name, get_requester_ip
-from .config import request_limit
-from .telegram import client, transfer
+from . import metrics
+from .util import get_requester_ip, parse_range
+from .tracker import RequestTracker
+from .cluster import Cluster, client_header
+from .cache import FileInfo
+from .links import parse_link_token, parse_bundle_token
+from .bundle import Bundle, CRCCache, Chunk, FetchRange
+from .paralleltransfer import max_part_size, get_ranges_part_size, RefreshLocation
+from .scheduler import SlotTimeoutError
+from .trace import current_trace, start_trace
+from .config import (request_limit, max_tracked_clients, ipv6_subnet_prefix, cache_control,
+                     cluster_peers, cluster_self, cluster_secret, admission_timeout,
+                     metadata_cache_size)
+from .telegram import transfer, file_cache
 
 log = logging.getLogger(__name__)
 routes = web.RouteTableDef()
-ongoing_requests: Dict[str, int] = defaultdict(lambda: 0)
+# The Retry-After header of responses to requests refused because the server is busy
+retry_after = 5
+# The most bytes outside of a requested bundle range that are downloaded to compute the CRCs it
+# needs. Ranges that need more are answered with the whole archive instead.
+max_crc_download = 16 * 1024 * 1024
+ongoing_requests = RequestTracker(request_limit, max_tracked_clients, ipv6_subnet_prefix)
+cluster = Cluster(cluster_peers, cluster_self, cluster_secret) if cluster_peers else None
+crc_cache = CRCCache(metadata_cache_size)
 
 
 @routes.head(r"/{id:\d+}/{name}")
-async def handle_head_request(req: web.Request) -> web.Response:
+async def handle_head_request(req: web.Request) -> web.StreamResponse:
     return await handle_request(req, head=True)
 
 
-@routes.get(r"/{id:\d+}/{name}")
-async def handle_get_request(req: web.Request) -> web.Response:
+@routes.get(r"/{id:\d+}/{name}", allow_head=False)
+async def handle_get_request(req: web.Request) -> web.StreamResponse:
     return await handle_request(req, head=False)
 
 
-def allow_request(ip: str) -> None:
-    return ongoing_requests[ip] < request_limit
+@routes.head(r"/f/{token}/{name}")
+async def handle_signed_head_request(req: web.Request) -> web.StreamResponse:
+    return await handle_request(req, head=True)
+
+
+@routes.get(r"/f/{token}/{name}", allow_head=False)
+async def handle_signed_get_request(req: web.Request) -> web.StreamResponse:
+    return await handle_request(req, head=False)
+
+
+@routes.head(r"/bundle/{token}/{name}")
+async def handle_bundle_head_request(req: web.Request) -> web.StreamResponse:
+    return await handle_bundle_request(req, head=True)
+
+
+@routes.get(r"/bundle/{token}/{name}", allow_head=False)
+async def handle_bundle_get_request(req: web.Request) -> web.StreamResponse:
+    return await handle_bundle_request(req, head=False)
+
+
+@web.middleware
+async def metrics_middleware(req: web.Request,
+                             handler: Callable[[web.Request], Awaitable[web.StreamResponse]]
+                             ) -> web.StreamResponse:
+    try:
+        resp = await handler(req)
+    except web.HTTPException as e:
+        metrics.responses.inc(1, str(e.status))
+        raise
+    metrics.responses.inc(1, str(resp.status))
+    return resp
+
+
+async def handle_metrics(_: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type="text/plain",
+                        headers={"Cache-Control": "no-cache"})
+
+
+def parse_http_date(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    return date if date.tzinfo else date.replace(tzinfo=timezone.utc)
+
+
+def is_not_modified(req: web.Request, etag: str, date: datetime) -> bool:
+    # If-Modified-Since is ignored when If-None-Match is present (RFC 7232 section 6)
+    if_none_match = req.headers.get("If-None-Match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+    since = parse_http_date(req.headers.get("If-Modified-Since"))
+    return since is not None and date.replace(microsecond=0) <= since
+
+
+def range_applies(req: web.Request, etag: str, date: datetime) -> bool:
+    # If-Range requires a strong match, otherwise the whole file is sent
+    if_range = req.headers.get("If-Range")
+    if not if_range:
+        return True
+    elif if_range.startswith(('"', "W/")):
+        return if_range.strip() == etag
+    return parse_http_date(if_range) == date.replace(microsecond=0)
+
+
+def get_validators(etag: str, date: datetime) -> Dict[str, str]:
+    validators = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(date.astimezone(timezone.utc), usegmt=True),
+    }
+    if cache_control:
+        validators["Cache-Control"] = cache_control
+    return validators
+
+
+def get_client_ip(req: web.Request) -> str:
+    ip = get_requester_ip(req)
+    if cluster and cluster.is_peer_request(req):
+        return req.headers.get(client_header, ip)
+    return ip
+
 
+def service_unavailable() -> web.Response:
+    return web.Response(status=503, text="503: Service Unavailable",
+                        headers={"Retry-After": str(retry_after)})
 
-def increment_counter(ip: str) -> None:
-    ongoing_requests[ip] += 1
 
+def make_refresh(file_id: int, info: FileInfo) -> RefreshLocation:
+    """Make a callback that looks up a new file reference for the file when it expires."""
 
-def decrement_counter(ip: str) -> None:
-    ongoing_requests[ip] -= 1
+    async def refresh() -> Optional[TypeMessageMedia]:
+        file_cache.invalidate(file_id)
+        new_info = await file_cache.get(file_id)
+        if not new_info or new_info.document_id != info.document_id:
+            return None
+        return new_info.media
 
+    return refresh
 
-async def handle_request(req: web.Request, head: bool = False) -> web.Response:
+
+MakeBody = Callable[[str], AsyncGenerator[Tuple[int, Chunk], None]]
+
+
+async def send_body(req: web.Request, ip: str, status: int, headers: Dict[str, str],
+                    length: int, make_body: MakeBody, description: str, request_start: float,
+                    part_size: int, part_headers: Optional[List[bytes]] = None,
+                    closing: bytes = b"") -> web.StreamResponse:
+    """Stream a response body of ranges with request limits and memory admission applied.
+
+    ``make_body`` is called with the client key for the fair scheduler and must return a
+    generator of ``(range index, chunk)`` tuples. One part of ``part_size`` bytes is reserved
+    from the memory budget before the body is started. For multipart responses, the header of each
+    range is written before its first chunk and ``closing`` after the last one. If the request
+    is traced, the trace is logged once the body has been sent.
+    """
+    client = ongoing_requests.acquire(ip)
+    if not client:
+        return web.Response(status=429)
+    trace = current_trace.get()
+    budget = transfer.memory_budget
+    admitted = False
+    try:
+        admission_start = time.monotonic()
+        admitted = not budget or await budget.reserve(part_size, admission_timeout)
+        if trace:
+            trace.admission_wait = time.monotonic() - admission_start
+        if not admitted:
+            return service_unavailable()
+        body = make_body(client)
+        # The response is started when the first chunk is ready, so a download that doesn't get
+        # a fetch slot in time can still be refused with 503, and one that fails with 502
+        resp: Optional[web.StreamResponse] = None
+        # The status to answer with if the download fails before the response is started
+        error_status: Optional[int] = None
+        written = 0
+        first_byte: Optional[float] = None
+        current_range = -1
+        try:
+            async for range_index, chunk in body:
+                if not resp:
+                    first_byte = time.monotonic() - request_start
+                    metrics.time_to_first_byte.observe(first_byte)
+                    resp = web.StreamResponse(status=status, headers=headers)
+                    await resp.prepare(req)
+                if part_headers and range_index != current_range:
+                    await resp.write(part_headers[range_index])
+                    current_range = range_index
+                # write() waits for the transport buffer to drain, so a slow client pauses the
+                # download instead of letting parts pile up in memory.
+                if trace:
+                    write_start = time.monotonic()
+                    await resp.write(chunk)
+                    trace.add_write(time.monotonic() - write_start)
+                else:
+                    await resp.write(chunk)
+                written += len(chunk)
+                metrics.bytes_served.inc(len(chunk))
+        except SlotTimeoutError:
+            if resp:
+                log.warning(f"Download of {description} to {ip} failed after {written}/{length}"
+                            " bytes: timed out waiting for a fetch slot")
+            error_status = 503
+        except Exception as e:
+            if req.transport is None or req.transport.is_closing():
+                log.debug(f"{ip} disconnected after {written}/{length} bytes")
+            else:
+                log.warning(f"Download of {description} to {ip} failed after {written}/{length}"
+                            f" bytes: {e!r}")
+            error_status = 502
+        finally:
+            await body.aclose()
+            if trace:
+                trace.finish(error_status if error_status and not resp else status, length,
+                             written, first_byte)
+        if not resp:
+            if error_status == 503:
+                return service_unavailable()
+            elif error_status:
+                return web.Response(status=502, text="502: Bad Gateway")
+            # The body is empty
+            resp = web.StreamResponse(status=status, headers=headers)
+            await resp.prepare(req)
+        if written != length:
+            # Close the connection so the client doesn't wait for the missing bytes
+            resp.force_close()
+        else:
+            await resp.write_eof(closing)
+        return resp
+    finally:
+        ongoing_requests.release(client)
+        if budget and admitted:
+            budget.release(part_size)
+
+
+async def handle_request(req: web.Request, head: bool = False) -> web.StreamResponse:
+    request_start = time.monotonic()
     file_name = req.match_info["name"]
-    file_id = int(req.match_info["id"])
-    peer, msg_id = unpack_id(file_id)
-    if not peer or not msg_id:
-        return web.Response(status=404, text="404: Not Found")
+    signed_info: Optional[FileInfo] = None
+    if "token" in req.match_info:
+        link = parse_link_token(req.match_info["token"], file_name)
+        if not link:
+            return web.Response(status=404, text="404: Not Found")
+        file_id, signed_info = link
+    else:
+        file_id = int(req.match_info["id"])
+    ip = get_client_ip(req)
+    if cluster and not cluster.is_peer_request(req):
+        owner = cluster.owner(file_id)
+        if owner != cluster.self_url:
+            resp = await cluster.proxy(req, owner, ip)
+            if resp:
+                return resp
+    trace = start_trace(file_id=file_id, range=req.headers.get("Range"))
+    if signed_info:
+        # Signed links don't need a lookup, but a cached copy may have a fresher file reference
+        info = file_cache.get_cached(file_id)
+        if not info or info.document_id != signed_info.document_id:
+            info = signed_info
+    else:
+        info = await file_cache.get(file_id)
+        if trace:
+            trace.lookup = time.monotonic() - request_start
+        if not info or info.name != file_name:
+            return web.Response(status=404, text="404: Not Found")
+
+    validators = get_validators(info.etag, info.date)
+    if is_not_modified(req, info.etag, info.date):
+        return web.Response(status=304, headers=validators)
+
+    size = info.size
+    try:
+        ranges = parse_range(req.headers.get("Range")
+                             if range_applies(req, info.etag, info.date) else None, size)
+    except ValueError:
+        return web.Response(status=416, text="416: Range Not Satisfiable",
+                            headers={"Content-Range": f"bytes */{size}"})
+    headers = {
+        **validators,
+        "Content-Disposition": f'attachment; filename="{file_name}"',
+        "Accept-Ranges": "bytes",
+    }
+    # The body parts of a multipart/byteranges response, which are written before each range
+    part_headers: List[bytes] = []
+    closing = b""
+    if not ranges or ranges == [(0, size)]:
+        ranges = [(0, size)]
+        status = 200
+        headers["Content-Type"] = info.mime_type
+        headers["Content-Length"] = str(size)
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        status = 206
+        headers["Content-Type"] = info.mime_type
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+        headers["Content-Length"] = str(end - start)
+    else:
+        boundary = secrets.token_hex(16)
+        part_headers = [(f"\r\n--{boundary}\r\n"
+                         f"Content-Type: {info.mime_type}\r\n"
+                         f"Content-Range: bytes {start}-{end - 1}/{size}\r\n"
+                         "\r\n").encode("utf-8")
+                        for start, end in ranges]
+        closing = f"\r\n--{boundary}--\r\n".encode("utf-8")
+        status = 206
+        headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+        headers["Content-Length"] = str(sum(end - start for start, end in ranges)
+                                        + sum(len(part) for part in part_headers)
+                                        + len(closing))
+    if head:
+        return web.Response(status=status, headers=headers)
+
+    range_str = ", ".join(f"{start} - {end}" for start, end in ranges)
+    log.info("Serving file in %d (chat %d) to %s; Range: %s", info.msg_id, info.chat_id, ip,
+             range_str)
+    part_size = get_ranges_part_size(ranges)
+    return await send_body(
+        req, ip, status, headers, length=sum(end - start for start, end in ranges),
+        make_body=lambda client: transfer.download(info.media, file_size=size, ranges=ranges,
+                                                   client_id=client,
+                                                   refresh=make_refresh(file_id, info),
+                                                   part_size=part_size),
+        description=f"{info.msg_id} (chat {info.chat_id})", request_start=request_start,
+        part_size=part_size, part_headers=part_headers, closing=closing)
 
-    message = cast(Message, await client.get_messages(entity=peer, ids=msg_id))
-    if not message or not message.file or get_file_name(message) != file_name:
+
+async def handle_bundle_request(req: web.Request, head: bool = False) -> web.StreamResponse:
+    request_start = time.monotonic()
+    bundle_name = req.match_info["name"]
+    file_ids = parse_bundle_token(req.match_info["token"], bundle_name)
+    if not file_ids:
+        return web.Response(status=404, text="404: Not Found")
+    trace = start_trace(bundle=len(file_ids), range=req.headers.get("Range"))
+    infos = await asyncio.gather(*[file_cache.get(file_id) for file_id in file_ids])
+    if trace:
+        trace.lookup = time.monotonic() - request_start
+    if not all(infos):
         return web.Response(status=404, text="404: Not Found")
+    bundle = Bundle(infos, crc_cache)
 
-    size = message.file.size
+    validators = get_validators(bundle.etag, bundle.date)
+    if is_not_modified(req, bundle.etag, bundle.date):
+        return web.Response(status=304, headers=validators)
+    size = bundle.size
     try:
-        offset = req.http_range.start or 0
-        limit = req.http_range.stop or size
-        if (limit > size) or (offset < 0) or (limit < offset):
-            raise ValueError("range not in acceptable format")
+        ranges = parse_range(req.headers.get("Range")
+                             if range_applies(req, bundle.etag, bundle.date) else None, size)
     except ValueError:
         return web.Response(status=416, text="416: Range Not Satisfiable",
                             headers={"Content-Range": f"bytes */{size}"})
-    if not head:
-        ip = get_requester_ip(req)
-        if not allow_request(ip):
-            return web.Response(status=429)
-        log.info(f"Serving file in {message.id} (chat {message.chat_id}) to {ip}; Range: {offset} - {limit}")
-        body = transfer.download(message.media, file_size=size, offset=offset, limit=limit)
+    headers = {
+        **validators,
+        "Content-Type": "application/zip",
+        "Content-Disposition": f'attachment; filename="{bundle_name}"',
+        "Accept-Ranges": "bytes",
+    }
+    # Bundles are for bulk downloads, so multiple ranges are answered with the whole archive
+    if (not ranges or len(ranges) > 1 or ranges == [(0, size)]
+            or bundle.crc_download_size(*ranges[0]) > max_crc_download):
+        start, end = 0, size
+        status = 200
     else:
-        body = None
-    return web.Response(status=206 if (limit-offset != size) else 200,
-                        body=body,
-                        headers={
-                            "Content-Type": message.file.mime_type,
-                            "Content-Range": f"bytes {offset}-{limit}/{size}",
-                            "Content-Length": str(limit - offset),
-                            "Content-Disposition": f'attachment; filename="{file_name}"',
-                            "Accept-Ranges": "bytes",
-                        })
+        start, end = ranges[0]
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+    headers["Content-Length"] = str(end - start)
+    if head:
+        return web.Response(status=status, headers=headers)
+
+    ip = get_client_ip(req)
+
+    refreshes = {info.document_id: make_refresh(file_id, info)
+                 for file_id, info in zip(file_ids, infos)}
+
+    def fetch(client: str) -> FetchRange:
+        return lambda info, offset, limit: transfer.download(
+            info.media, file_size=info.size, ranges=[(offset, limit)], client_id=client,
+            refresh=refreshes[info.document_id])
+
+    log.info("Serving bundle of %d files to %s; Range: %d - %d", len(infos), ip, start, end)
+    # The files are read in long ranges, which use the largest parts
+    return await send_body(req, ip, status, headers, length=end - start,
+                           make_body=lambda client: bundle.stream(start, end, fetch(client)),
+                           description=f"bundle of {len(infos)} files",
+                           request_start=request_start, part_size=max_part_size)